@@ -2,6 +2,10 @@ import re
 import sys
 import os
 import time
+import atexit
+import shutil
+import subprocess
+from functools import lru_cache
 try:
     import msvcrt
 except ImportError:
@@ -14,10 +18,64 @@ variables = {}
 functions = {}
 labels = {}
 program_lines = []
+program_code = []
+function_code = {}
 current_line = 0
 current_fg = None
 current_bg = None
+current_ansi = ""
 fs_state = None
+fs_tree = None
+fs_dirty = False
+hardware_log = None
+terminal_cols = None
+terminal_cols_checked = 0.0
+
+# ------------------------------
+# Compiled Patterns
+# ------------------------------
+META_SPLIT_RE = re.compile(r"[,\s]+")
+COMMENT_SCAN_RE = re.compile(r"\"[^\"]*\"?|'[^']*'?|(//|#)")
+VAR_SUB_RE = re.compile(r"<`(.*?)`>")
+SET_RE = re.compile(r"Set\[(.*?)\]\s*=\s*(.*)")
+DISPLAY_TEXT_RE = re.compile(r"DisplayText\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$")
+DISPLAY_TEXT_RAW_RE = re.compile(r"DisplayTextRaw\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$")
+FS_CREATE_RE = re.compile(r"FS\[Create\]\[(.*?)\]\s*(?:=\s*(.*))?$")
+FS_READ_RE = re.compile(r"FS\[Read\]\[(.*?)\]\s*$")
+FS_WRITE_RE = re.compile(r"FS\[Write\]\[(.*?)\]\s*=\s*(.*)$")
+FS_LIST_RE = re.compile(r"FS\[List\](?:\[(.*?)\])?\s*$")
+FS_SET_ROLE_RE = re.compile(r"FS\[SetRole\]\[(.*?)\]\s*=\s*(.*)$")
+FS_TRAN_RE = re.compile(r"FS\[Tran\]\[(.*?)\]\s*$")
+BLOCK_ALLOC_RE = re.compile(r"Block\[Alloc\]\s*$")
+BLOCK_READ_RE = re.compile(r"Block\[Read\]\[(.*?)\]\s*$")
+BLOCK_WRITE_RE = re.compile(r"Block\[Write\]\[(.*?)\]\s*=\s*(.*)$")
+WRITE_FILE_RE = re.compile(r"WriteFile(?:\[(.*?)\])?\s*(?:=\s*(.*))?$")
+APPEND_FILE_RE = re.compile(r"AppendFile\[(.*?)\]\s*=\s*(.*)$")
+TRACK_INPUT_INSTANT_RE = re.compile(r"TrackInput\[\s*KEYBOARD\s*\]\s*=\s*INSTANT\s*$", re.IGNORECASE)
+TRACK_INPUT_NOBLOCK_RE = re.compile(r"TrackInput\[\s*KEYBOARD\s*\]\s*=\s*NOBLOCK\s*$", re.IGNORECASE)
+SET_COLOR_RE = re.compile(r"SetColor\[(FG|BG)\]\s*=\s*(.*)$", re.IGNORECASE)
+DRAW_BOX_RE = re.compile(r"DrawBox\[(\d+)\s*,\s*(\d+)\]\s*=\s*(.*)$")
+SET_CURSOR_RE = re.compile(r"SetCursor\[(.*?)\s*,\s*(.*?)\]\s*$")
+TICK_TIMER_RE = re.compile(r"TickTimer\[(.*?)\]\s*$")
+TIME_RE = re.compile(r"Time\[(MS|SEC|MIN)\]\s*=\s*(.*)$", re.IGNORECASE)
+CALL_FUNCTION_RE = re.compile(r"CallFunction\[(.*?)\]\s*(?:->\s*(\S+)\s*)?$")
+COMMAND_HEAD_RE = re.compile(r"[^\[(]*[\[(]?")
+# Label[NAME] (group 1) or the deprecated Label:NAME (group 2).
+LABEL_RE = re.compile(r"Label(?:\[([^\]]*)\]|:(.*))")
+IF_OP_RE = re.compile(r"If\[(.*?)\]\s*(>=|<=|=|>|<)\s*(.+)$")
+UINT_PREFIX_RE = re.compile(r"[0-9]*")
+MATH_NUMBER_RE = re.compile(r"(?:0|[1-9][0-9]*)(?:\.[0-9]+)?")
+# Anything NASM cannot take inside a double-quoted string: the quote
+# itself, control characters and non-ASCII text.
+NASM_UNQUOTABLE_RE = re.compile(r'([^ !#-~]+)')
+VM_MATH_RE = re.compile(r"Math\(\s*<`(.*?)`>\s*([+\-])\s*(<`(.*?)`>|\d+)\s*\)\s*$")
+DIGITS_RE = re.compile(r"\d+")
+SIGNED_DIGITS_RE = re.compile(r"-?\d+")
+STAGE2_SECTORS_RE = re.compile(rb"STAGE2_SECTORS\s+equ\s+\d+")
+
+# Structural-only keywords, compared with spaces removed so the bit
+# declaration may be written as "[16 BIT]".
+STRUCTURAL_KEYWORDS = frozenset(("[16BIT]", "startprogram", "endprogram", "startsection", "endsection"))
 
 # ------------------------------
 # Utilities
@@ -29,44 +87,110 @@ def get_repo_root():
 def ensure_dir(path):
     os.makedirs(path, exist_ok=True)
 
+# Resolved once: fs_save runs at exit, when __main__.__file__ is already gone.
+@lru_cache(maxsize=None)
 def fs_db_path():
-    return os.path.join(get_repo_root(), "build", "lush_fs.json")
+    return os.path.join(get_repo_root(), "build", "lush_fs.pickle")
+
+def fs_legacy_db_path():
+    # Older builds stored the state as JSON; it is still read if no pickle exists.
+    return os.path.join(os.path.dirname(fs_db_path()), "lush_fs.json")
+
+FS_MAX_VERSIONS = 16
 
 def fs_default_state():
     return {
         "block_size": 4096,
-        "next_block_id": 1,
-        "blocks": {},
+        "blocks": [],
+        "free_blocks": [],
         "files": {},
     }
 
+def fs_upgrade_state(state):
+    """Convert state saved with string-keyed blocks to the block list layout.
+    Block N lives at blocks[N - 1]; None marks an id that is not allocated.
+    """
+    state.setdefault("free_blocks", [])
+    blocks = state["blocks"]
+    if isinstance(blocks, list):
+        return state
+    blocks_list = [None] * (int(state.pop("next_block_id", 1)) - 1)
+    for block_id, content in blocks.items():
+        index = int(block_id) - 1
+        if index >= len(blocks_list):
+            blocks_list.extend([None] * (index + 1 - len(blocks_list)))
+        blocks_list[index] = content
+    state["blocks"] = blocks_list
+    for file_entry in state["files"].values():
+        file_entry["blocks"] = [int(b) for b in file_entry["blocks"]]
+        for version in file_entry.get("versions", []):
+            version["blocks"] = [int(b) for b in version["blocks"]]
+    return state
+
 def fs_load():
-    global fs_state
+    """Load the FS state from disk. The FS helpers below assume this has run;
+    the parsers call it when they first see an FS or Block command, so it
+    happens once at load time instead of on every operation. Changes are
+    written back once, at exit.
+    """
+    global fs_state, fs_tree
     if fs_state is not None:
         return
+    atexit.register(fs_save)
     path = fs_db_path()
-    if os.path.exists(path):
-        try:
+    legacy_path = fs_legacy_db_path()
+    try:
+        if os.path.exists(path):
+            import pickle
+            with open(path, "rb") as f:
+                fs_state = fs_upgrade_state(pickle.load(f))
+        elif os.path.exists(legacy_path):
             import json
-            with open(path, "r", encoding="utf-8") as f:
-                fs_state = json.load(f)
-        except Exception:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                fs_state = fs_upgrade_state(json.load(f))
+        else:
             fs_state = fs_default_state()
-    else:
+    except Exception:
         fs_state = fs_default_state()
 
+    # The directory tree is derived from the file paths, so it is rebuilt
+    # here rather than saved with the state.
+    fs_tree = fs_new_dir_node()
+    for path in fs_state["files"]:
+        fs_index_file(path)
+
 def fs_save():
-    if fs_state is None:
+    global fs_dirty
+    if not fs_dirty:
         return
     try:
-        import json
+        import pickle
         build_dir = os.path.dirname(fs_db_path())
         ensure_dir(build_dir)
-        with open(fs_db_path(), "w", encoding="utf-8") as f:
-            json.dump(fs_state, f, indent=2, sort_keys=True)
+        with open(fs_db_path(), "wb") as f:
+            pickle.dump(fs_state, f, pickle.HIGHEST_PROTOCOL)
+        fs_dirty = False
     except Exception as e:
         print(f"[ERROR] Failed to save FS state: {e}")
 
+def fs_new_dir_node():
+    return {"dirs": {}, "files": set()}
+
+def fs_index_file(path):
+    """Add a file path to fs_tree, creating its parent directory nodes."""
+    if not path.startswith("/"):
+        return
+    parts = path.split("/")
+    node = fs_tree
+    for name in parts[1:-1]:
+        child = node["dirs"].get(name)
+        if child is None:
+            child = node["dirs"][name] = fs_new_dir_node()
+        node = child
+    if parts[-1]:
+        node["files"].add(parts[-1])
+
+@lru_cache(maxsize=4096)
 def fs_normalize_path(path):
     path = (path or "").strip()
     if not path:
@@ -84,7 +208,7 @@ def fs_parse_meta(meta_text):
     text = meta_text.strip()
     if text.startswith('"') and text.endswith('"'):
         text = text[1:-1]
-    for token in re.split(r"[,\s]+", text.strip()):
+    for token in META_SPLIT_RE.split(text.strip()):
         if not token or "=" not in token:
             continue
         key, val = token.split("=", 1)
@@ -95,36 +219,63 @@ def fs_parse_meta(meta_text):
     return meta
 
 def fs_alloc_block():
-    fs_load()
-    block_id = fs_state["next_block_id"]
-    fs_state["next_block_id"] = block_id + 1
-    fs_state["blocks"][str(block_id)] = ""
-    return str(block_id)
+    global fs_dirty
+    fs_dirty = True
+    blocks = fs_state["blocks"]
+    free_blocks = fs_state["free_blocks"]
+    if free_blocks:
+        block_id = free_blocks.pop()
+        blocks[block_id - 1] = ""
+        return block_id
+    blocks.append("")
+    return len(blocks)
+
+def fs_free_blocks(block_ids):
+    """Release block ids so fs_alloc_block and fs_write_file can reuse them.
+
+    A released id reads as not allocated only until it is reused; after that
+    Block[Read]/Block[Write] on it reach whatever now owns the block.
+    """
+    blocks = fs_state["blocks"]
+    for block_id in block_ids:
+        blocks[block_id - 1] = None
+    fs_state["free_blocks"].extend(block_ids)
+
+def fs_block_index(block_id):
+    """Position of block_id in fs_state["blocks"], or None if it is not allocated."""
+    try:
+        index = int(block_id) - 1
+    except (TypeError, ValueError):
+        return None
+    blocks = fs_state["blocks"]
+    if 0 <= index < len(blocks) and blocks[index] is not None:
+        return index
+    return None
 
 def fs_write_block(block_id, content):
-    fs_load()
-    block_id = str(block_id)
-    if block_id not in fs_state["blocks"]:
+    index = fs_block_index(block_id)
+    if index is None:
         print(f"[ERROR] Block '{block_id}' not allocated.")
         return False
+    global fs_dirty
+    fs_dirty = True
     block_size = int(fs_state.get("block_size", 4096))
-    fs_state["blocks"][block_id] = (content or "")[:block_size]
+    fs_state["blocks"][index] = (content or "")[:block_size]
     return True
 
 def fs_read_block(block_id):
-    fs_load()
-    block_id = str(block_id)
-    if block_id not in fs_state["blocks"]:
+    index = fs_block_index(block_id)
+    if index is None:
         print(f"[ERROR] Block '{block_id}' not allocated.")
         return ""
-    return fs_state["blocks"].get(block_id, "")
+    return fs_state["blocks"][index]
 
 def fs_get_file(path):
-    fs_load()
     return fs_state["files"].get(path)
 
 def fs_create_file(path, meta=None):
-    fs_load()
+    global fs_dirty
+    fs_dirty = True
     now = time.time()
     defaults = {
         "role": "doc",
@@ -145,143 +296,178 @@ def fs_create_file(path, meta=None):
         "created": now,
         "modified": now,
     }
+    fs_index_file(path)
 
 def fs_write_file(path, content):
-    fs_load()
+    global fs_dirty
+    fs_dirty = True
     file_entry = fs_get_file(path)
     if file_entry is None:
         fs_create_file(path)
         file_entry = fs_get_file(path)
-    if file_entry["blocks"]:
-        file_entry["versions"].append({
-            "blocks": list(file_entry["blocks"]),
+    # Only backup=versioned files keep history, and only the newest
+    # FS_MAX_VERSIONS of it. The old block list is replaced below, not
+    # mutated, so the version can hold it without a copy.
+    if file_entry["blocks"] and file_entry.get("backup") == "versioned":
+        versions = file_entry["versions"]
+        versions.append({
+            "blocks": file_entry["blocks"],
             "size": file_entry["size"],
             "ts": time.time(),
         })
+        if len(versions) > FS_MAX_VERSIONS:
+            for version in versions[:-FS_MAX_VERSIONS]:
+                fs_free_blocks(version["blocks"])
+            del versions[:-FS_MAX_VERSIONS]
+    else:
+        fs_free_blocks(file_entry["blocks"])
     block_size = int(fs_state.get("block_size", 4096))
     content = content or ""
-    blocks = []
-    if content:
-        for i in range(0, len(content), block_size):
-            chunk = content[i:i + block_size]
-            block_id = fs_alloc_block()
-            fs_write_block(block_id, chunk)
-            blocks.append(block_id)
-    file_entry["blocks"] = blocks
+    # Fill released blocks first, then allocate the rest in one extend; ids
+    # are 1-based.
+    chunks = [content[i:i + block_size] for i in range(0, len(content), block_size)]
+    blocks = fs_state["blocks"]
+    free_blocks = fs_state["free_blocks"]
+    reused = [free_blocks.pop() for _ in range(min(len(free_blocks), len(chunks)))]
+    for block_id, chunk in zip(reused, chunks):
+        blocks[block_id - 1] = chunk
+    first_id = len(blocks) + 1
+    blocks.extend(chunks[len(reused):])
+    file_entry["blocks"] = reused + list(range(first_id, first_id + len(chunks) - len(reused)))
     file_entry["size"] = len(content)
     file_entry["modified"] = time.time()
 
 def fs_read_file(path):
-    fs_load()
     file_entry = fs_get_file(path)
     if file_entry is None:
         print(f"[ERROR] File '{path}' not found.")
         return ""
-    content = []
-    for block_id in file_entry.get("blocks", []):
-        content.append(fs_read_block(block_id))
-    return "".join(content)
+    blocks = fs_state["blocks"]
+    return "".join([blocks[block_id - 1] for block_id in file_entry.get("blocks", [])])
 
 def fs_list_dir(path):
-    fs_load()
     prefix = fs_normalize_path(path)
     if not prefix.endswith("/"):
         prefix += "/"
-    entries = set()
-    for file_path in fs_state["files"].keys():
-        if not file_path.startswith(prefix):
-            continue
-        remainder = file_path[len(prefix):]
-        if not remainder:
-            continue
-        if "/" in remainder:
-            entries.add(remainder.split("/", 1)[0] + "/")
-        else:
-            entries.add(remainder)
-    return sorted(entries)
+    node = fs_tree
+    for name in prefix.split("/")[1:-1]:
+        node = node["dirs"].get(name)
+        if node is None:
+            return []
+    return sorted([name + "/" for name in node["dirs"]] + list(node["files"]))
 
 def fs_set_role(path, role):
-    fs_load()
     file_entry = fs_get_file(path)
     if file_entry is None:
         print(f"[ERROR] File '{path}' not found.")
         return False
+    global fs_dirty
+    fs_dirty = True
     file_entry["role"] = role
     file_entry["modified"] = time.time()
     return True
 
 def fs_tran(path):
-    fs_load()
     file_entry = fs_get_file(path)
     if file_entry is None:
         print(f"[ERROR] File '{path}' not found.")
         return False
+    global fs_dirty
+    fs_dirty = True
     file_entry["role"] = "Tran"
     file_entry["run"] = "bg"
     file_entry["modified"] = time.time()
     return True
 
+def bracket_arg(line, start):
+    """Text from line[start:] up to the first ']', or to the end without one."""
+    end = line.find("]", start)
+    return line[start:] if end < 0 else line[start:end]
+
+def is_structural(line):
+    """True for structural-only lines such as "[16 BIT]" or "startprogram"."""
+    # Every keyword starts with '[', 's' or 'e', so other lines skip the
+    # space-stripping copy.
+    return line[:1] in "[se" and line.replace(" ", "") in STRUCTURAL_KEYWORDS
+
 def strip_inline_comment(line: str) -> str:
     """Remove inline comments (// or #) that occur outside quotes.
     Supports single ('') and double ("") quoted strings. No escape handling.
     """
-    in_single = False
-    in_double = False
-    i = 0
-    while i < len(line):
-        ch = line[i]
-        if ch == '"' and not in_single:
-            in_double = not in_double
-            i += 1
-            continue
-        if ch == "'" and not in_double:
-            in_single = not in_single
-            i += 1
-            continue
-        if not in_single and not in_double:
-            if ch == '/' and i + 1 < len(line) and line[i+1] == '/':
-                return line[:i].rstrip()
-            if ch == '#':
-                return line[:i].rstrip()
-        i += 1
+    if "/" not in line and "#" not in line:
+        return line.rstrip()
+    if '"' not in line and "'" not in line:
+        # Nothing quoted: the first marker is the comment.
+        cut = line.find("//")
+        hash_at = line.find("#")
+        if hash_at != -1 and (cut == -1 or hash_at < cut):
+            cut = hash_at
+        return (line if cut == -1 else line[:cut]).rstrip()
+    # Quoted runs (an unterminated quote runs to end of line) are skipped whole,
+    # so the first comment marker matched is outside any quotes.
+    for match in COMMENT_SCAN_RE.finditer(line):
+        if match.group(1):
+            return line[:match.start()].rstrip()
     return line.rstrip()
 
 def substitute_variables(text):
     """Replace <`VAR`> with its value."""
-    matches = re.findall(r"<`(.*?)`>", text)
-    for var in matches:
-        value = variables.get(var, f"<UNDEFINED:{var}>")
-        text = text.replace(f"<`{var}`>", value)
-    return text
-
-def parse_value(value):
-    """Handles quoted strings or variable references."""
-    value = value.strip()
-    if value.startswith('"') and value.endswith('"'):
-        return value.strip('"')
-    return variables.get(value, value)
+    if "<`" not in text:
+        return text
+    get = variables.get
+    return VAR_SUB_RE.sub(lambda m: get(m.group(1), f"<UNDEFINED:{m.group(1)}>"), text)
+
+@lru_cache(maxsize=4096)
+def split_template(text):
+    """Pre-split a <`VAR`> template for render_template: literal text at even
+    indices, interned variable names at odd ones.
+    """
+    parts = VAR_SUB_RE.split(text)
+    for i in range(1, len(parts), 2):
+        parts[i] = sys.intern(parts[i])
+    return tuple(parts)
+
+def render_template(parts):
+    """Fill a split_template result with the current variable values."""
+    if len(parts) == 1:
+        return parts[0]
+    out = list(parts)
+    get = variables.get
+    for i in range(1, len(out), 2):
+        name = out[i]
+        out[i] = get(name, f"<UNDEFINED:{name}>")
+    return "".join(out)
+
+@lru_cache(maxsize=1024)
+def split_token(token):
+    """Split a value token once: returns (template parts, quoted). Tokens come
+    from parsed program lines, so the same few strings repeat at run time.
+    """
+    token = token.strip()
+    if token.startswith('"') and token.endswith('"'):
+        return split_template(token.strip('"')), True
+    return split_template(token), False
 
 def parse_token_value(token):
     """Parse a token that may be quoted, contain <`VAR`>, or be a variable name."""
     if token is None:
         return ""
-    token = token.strip()
-    if token.startswith('"') and token.endswith('"'):
-        return substitute_variables(token.strip('"'))
-    token = substitute_variables(token)
-    return variables.get(token, token)
+    parts, quoted = split_token(token)
+    value = render_template(parts)
+    if quoted:
+        return value
+    return variables.get(value, value)
 
 def parse_path_token(token):
     """Parse a path token that may be quoted and include variable substitutions."""
     return parse_token_value(token)
 
-def eval_math(expr):
-    """Safely evaluate a math expression containing numbers and operators."""
+@lru_cache(maxsize=512)
+def compile_math(expr, slots=()):
+    """Parse and validate a math expression once, returning a code object.
+    Only numbers and arithmetic operators are accepted, plus the names in slots.
+    """
     import ast
-    expr = expr.strip()
-    expr = substitute_variables(expr)
-    if expr.startswith('"') and expr.endswith('"'):
-        expr = expr[1:-1]
 
     allowed_nodes = (
         ast.Expression,
@@ -290,61 +476,97 @@ def eval_math(expr):
         ast.Constant,
         ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
         ast.UAdd, ast.USub,
-        ast.Load,
+        ast.Name, ast.Load,
     )
+    binary_ops = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
 
-    def _eval(node):
+    def _check(node):
         if not isinstance(node, allowed_nodes):
             raise ValueError("Invalid math expression")
         if isinstance(node, ast.Expression):
-            return _eval(node.body)
-        if isinstance(node, ast.Constant):
-            if isinstance(node.value, (int, float)):
-                return node.value
-            raise ValueError("Only numeric constants allowed")
-        if isinstance(node, ast.UnaryOp):
-            operand = _eval(node.operand)
-            if isinstance(node.op, ast.UAdd):
-                return +operand
-            if isinstance(node.op, ast.USub):
-                return -operand
-            raise ValueError("Invalid unary operator")
-        if isinstance(node, ast.BinOp):
-            left = _eval(node.left)
-            right = _eval(node.right)
-            if isinstance(node.op, ast.Add):
-                return left + right
-            if isinstance(node.op, ast.Sub):
-                return left - right
-            if isinstance(node.op, ast.Mult):
-                return left * right
-            if isinstance(node.op, ast.Div):
-                return left / right
-            if isinstance(node.op, ast.FloorDiv):
-                return left // right
-            if isinstance(node.op, ast.Mod):
-                return left % right
-            if isinstance(node.op, ast.Pow):
-                return left ** right
-            raise ValueError("Invalid binary operator")
-        raise ValueError("Invalid math expression")
+            _check(node.body)
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError("Only numeric constants allowed")
+        elif isinstance(node, ast.Name):
+            if node.id not in slots:
+                raise ValueError("Invalid math expression")
+        elif isinstance(node, ast.UnaryOp):
+            _check(node.operand)
+            if not isinstance(node.op, (ast.UAdd, ast.USub)):
+                raise ValueError("Invalid unary operator")
+        elif isinstance(node, ast.BinOp):
+            _check(node.left)
+            _check(node.right)
+            if not isinstance(node.op, binary_ops):
+                raise ValueError("Invalid binary operator")
+        else:
+            raise ValueError("Invalid math expression")
 
     tree = ast.parse(expr, mode="eval")
-    return _eval(tree)
+    _check(tree)
+    return compile(tree, "<math>", "eval")
+
+@lru_cache(maxsize=512)
+def compile_math_template(expr):
+    """Compile a Math() source with each <`VAR`> as a slot instead of its text.
+
+    Returns (code, names), where slot _v<i> takes the value of names[i], or
+    None if the expression has no variables or cannot be compiled this way
+    (e.g. a reference glued to other characters).
+    """
+    expr = expr.strip()
+    if "<`" not in expr or '"' in expr:
+        return None
+    # Text the user wrote around the references must not spell a slot name,
+    # or Math(_v0+<`A`>) would read A twice instead of being rejected.
+    if any("_v" in literal for literal in VAR_SUB_RE.split(expr)[::2]):
+        return None
+    names = []
+    def to_slot(match):
+        names.append(match.group(1))
+        return f"_v{len(names) - 1}"
+    source = VAR_SUB_RE.sub(to_slot, expr)
+    slots = tuple(f"_v{i}" for i in range(len(names)))
+    try:
+        return compile_math(source, slots), tuple(names)
+    except (SyntaxError, ValueError):
+        return None
 
-def ansi_prefix():
-    """Build ANSI prefix based on current colors."""
+def eval_math(expr):
+    """Safely evaluate a math expression containing numbers and operators."""
+    # Loops re-evaluate the same expression with new values, so bind plain
+    # numbers into the compiled template instead of re-parsing the text.
+    # Any other value (negative, spaced, non-numeric) gets substituted as text,
+    # which can parse differently.
+    compiled = compile_math_template(expr)
+    if compiled is not None:
+        code, names = compiled
+        slots = {}
+        for i, name in enumerate(names):
+            value = variables.get(name)
+            if not isinstance(value, str) or not MATH_NUMBER_RE.fullmatch(value):
+                break
+            slots[f"_v{i}"] = float(value) if "." in value else int(value)
+        else:
+            return eval(code, {"__builtins__": {}}, slots)
+    expr = expr.strip()
+    expr = substitute_variables(expr)
+    if expr.startswith('"') and expr.endswith('"'):
+        expr = expr[1:-1]
+    return eval(compile_math(expr), {"__builtins__": {}}, {})
+
+ANSI_RESET = "\033[0m"
+
+def update_ansi_prefix():
+    """Rebuild the cached ANSI prefix after the current colors change."""
+    global current_ansi
     codes = []
     if current_fg:
         codes.append(current_fg)
     if current_bg:
         codes.append(current_bg)
-    if not codes:
-        return ""
-    return f"\033[{';'.join(codes)}m"
-
-def ansi_reset():
-    return "\033[0m"
+    current_ansi = f"\033[{';'.join(codes)}m" if codes else ""
 
 def set_color(tag, value):
     global current_fg, current_bg
@@ -378,11 +600,13 @@ def set_color(tag, value):
             current_bg = bg_map[key]
         else:
             print(f"[WARN] Unknown BG color '{value}'")
+    update_ansi_prefix()
 
 def reset_color():
     global current_fg, current_bg
     current_fg = None
     current_bg = None
+    update_ansi_prefix()
 
 def clear_screen():
     """Clear screen and move cursor to home position."""
@@ -436,194 +660,209 @@ def draw_box(width, height, ch):
         ch = "#"
     ch = ch[0]
     if w == 1:
-        for _ in range(h):
-            display_to_shell(ch)
-        return
-    if h == 1:
-        display_to_shell(ch * w)
-        return
-    top = ch * w
-    mid = ch + (" " * (w - 2)) + ch
-    display_to_shell(top)
-    for _ in range(h - 2):
-        display_to_shell(mid)
-    display_to_shell(top)
+        rows = [ch] * h
+    elif h == 1:
+        rows = [ch * w]
+    else:
+        top = ch * w
+        mid = ch + (" " * (w - 2)) + ch
+        rows = [top] + [mid] * (h - 2) + [top]
+    # Same bytes as one display_to_shell call per row, in a single write.
+    prefix = current_ansi
+    if prefix:
+        reset = ANSI_RESET
+        rows = [f"{prefix}{row}{reset}" for row in rows]
+    sys.stdout.write("\n".join(rows) + "\n")
 
 def normalize_input(text):
     """Lowercase and collapse whitespace for command parsing."""
-    text = text.strip().lower()
-    if not text:
-        return ""
-    return " ".join(text.split())
+    return " ".join(text.lower().split())
 
 def set_word_vars(text):
     """Populate WORD1/WORD2/WORD3 and WORDCOUNT from normalized input."""
-    words = text.split() if text else []
+    words = text.split()
     variables["WORDCOUNT"] = str(len(words))
-    variables["WORD1"] = words[0] if len(words) > 0 else ""
-    variables["WORD2"] = words[1] if len(words) > 1 else ""
-    variables["WORD3"] = words[2] if len(words) > 2 else ""
+    words.extend(("", "", ""))
+    variables["WORD1"] = words[0]
+    variables["WORD2"] = words[1]
+    variables["WORD3"] = words[2]
 
 def send_to_hardware(text, add_newline=True):
     """Simulate writing to hardware by appending to a hardware_output.log file next to the script.
     This keeps real hardware access safe while giving a place to inspect DIRECT output.
+    The log is opened on first use and stays open until exit.
     """
+    global hardware_log
     try:
-        build_dir = os.path.join(get_repo_root(), "build")
-        ensure_dir(build_dir)
-        log_path = os.path.join(build_dir, "hardware_output.log")
-        with open(log_path, "a", encoding="utf-8") as f:
-            if add_newline:
-                f.write(text + "\n")
-            else:
-                f.write(text)
+        if hardware_log is None:
+            build_dir = os.path.join(get_repo_root(), "build")
+            ensure_dir(build_dir)
+            log_path = os.path.join(build_dir, "hardware_output.log")
+            hardware_log = open(log_path, "a", encoding="utf-8")
+            atexit.register(hardware_log.close)
+        if add_newline:
+            hardware_log.write(text + "\n")
+        else:
+            hardware_log.write(text)
     except Exception as e:
         print(f"[ERROR] Failed to write to hardware log: {e}")
 
 
 def display_to_shell(text):
     """Send text to the interactive shell (stdout)."""
-    prefix = ansi_prefix()
-    if prefix:
-        print(f"{prefix}{text}{ansi_reset()}")
+    if current_ansi:
+        print(f"{current_ansi}{text}{ANSI_RESET}")
     else:
         print(text)
 
 # ------------------------------
 # Instruction Handlers
 # ------------------------------
-def handle_set(line):
+def handle_nothing():
+    return
+
+def report_error(message):
+    print(message)
+
+def report_unknown_command(line):
+    print(f"[ERROR] Unknown command: {line}")
+
+NOP = (handle_nothing, ())
+
+def parse_set(line):
     # Example: Set[USER]= "Logan"
-    match = re.match(r"Set\[(.*?)\]\s*=\s*(.*)", line)
+    match = SET_RE.match(line)
     if not match:
-        print(f"[ERROR] Invalid Set syntax: {line}")
-        return
+        return report_error, (f"[ERROR] Invalid Set syntax: {line}",)
 
-    var_name = match.group(1)
+    var_name = sys.intern(match.group(1))
     raw_value = match.group(2).strip()
 
+    # The value form never changes, so pick the specialised handler once here.
     # Math evaluation: Set[X]=Math(1+2*3)
     if raw_value.startswith("Math(") and raw_value.endswith(")"):
-        expr = raw_value[5:-1]
-        try:
-            result = eval_math(expr)
-            variables[var_name] = str(result)
-        except Exception as e:
-            print(f"[ERROR] Math evaluation failed: {e}")
-        return
+        return handle_set_math, (var_name, raw_value[5:-1])
 
     # ReadFile: Set[VAR]=ReadFile["path"]
     if raw_value.startswith("ReadFile[") and raw_value.endswith("]"):
-        path_token = raw_value[len("ReadFile["):-1]
-        file_path = parse_path_token(path_token)
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                variables[var_name] = f.read()
-        except Exception as e:
-            print(f"[ERROR] ReadFile failed: {e}")
-        return
+        return handle_set_read_file, (var_name, raw_value[len("ReadFile["):-1])
 
     # FS[Read]: Set[VAR]=FS[Read]["path"]
-    fs_read_match = re.match(r"FS\[Read\]\[(.*?)\]\s*$", raw_value)
+    fs_read_match = FS_READ_RE.match(raw_value)
     if fs_read_match:
-        file_path = fs_normalize_path(parse_path_token(fs_read_match.group(1)))
-        variables[var_name] = fs_read_file(file_path)
-        variables["LASTREADPATH"] = file_path
-        variables["LASTREAD"] = variables[var_name]
-        variables["LASTREADSIZE"] = str(len(variables[var_name]))
-        fs_save()
-        return
+        fs_load()
+        return handle_set_fs_read, (var_name, fs_read_match.group(1))
 
     # FS[List]: Set[VAR]=FS[List]["path"]
-    fs_list_match = re.match(r"FS\[List\](?:\[(.*?)\])?\s*$", raw_value)
+    fs_list_match = FS_LIST_RE.match(raw_value)
     if fs_list_match:
-        list_path = fs_normalize_path(parse_path_token(fs_list_match.group(1)))
-        entries = fs_list_dir(list_path)
-        variables[var_name] = ",".join(entries)
-        variables["LASTLISTPATH"] = list_path
-        variables["LASTLIST"] = variables[var_name]
-        variables["LASTLISTCOUNT"] = str(len(entries))
-        fs_save()
-        return
+        fs_load()
+        return handle_set_fs_list, (var_name, fs_list_match.group(1))
 
     # Block[Alloc]: Set[VAR]=Block[Alloc]
-    if re.match(r"Block\[Alloc\]\s*$", raw_value):
-        block_id = fs_alloc_block()
-        variables[var_name] = block_id
-        variables["LASTBLOCK"] = block_id
-        fs_save()
-        return
+    if BLOCK_ALLOC_RE.match(raw_value):
+        fs_load()
+        return handle_set_block_alloc, (var_name,)
 
     # Block[Read]: Set[VAR]=Block[Read][id]
-    block_read_match = re.match(r"Block\[Read\]\[(.*?)\]\s*$", raw_value)
+    block_read_match = BLOCK_READ_RE.match(raw_value)
     if block_read_match:
-        block_id = parse_token_value(block_read_match.group(1))
-        variables[var_name] = fs_read_block(block_id)
-        variables["LASTBLOCK"] = str(block_id)
-        fs_save()
-        return
+        fs_load()
+        return handle_set_block_read, (var_name, block_read_match.group(1))
 
     # Support DisplayText(TAG)=... where TAG can be DIRECT or SHELL (case-insensitive)
-    dt_match = re.match(r"DisplayText\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$", raw_value)
+    dt_match = DISPLAY_TEXT_RE.match(raw_value)
     if dt_match:
-        tag = dt_match.group(1).strip().upper()
-        value = dt_match.group(3).strip()
-        value = substitute_variables(value)
-        # Route according to tag
-        if tag == "DIRECT":
-            # do not print to shell; write to simulated hardware
-            send_to_hardware(value)
-            # store the raw value in variable as well, in case code expects it
-            variables[var_name] = value
-        elif tag == "SHELL":
-            display_to_shell(value)
-            variables[var_name] = value
-        else:
-            # Unknown tag: default to shell and warn
-            print(f"[WARN] Unknown DisplayText tag '{tag}', defaulting to SHELL")
-            display_to_shell(value)
-            variables[var_name] = value
-        return
+        return (handle_set_display, (var_name,) + display_args(dt_match))
 
     # Support DisplayTextRaw(TAG)=... where TAG can be DIRECT or SHELL (case-insensitive)
-    dtr_match = re.match(r"DisplayTextRaw\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$", raw_value)
+    dtr_match = DISPLAY_TEXT_RAW_RE.match(raw_value)
     if dtr_match:
-        tag = dtr_match.group(1).strip().upper()
-        value = dtr_match.group(3).strip()
-        value = substitute_variables(value)
-        if tag == "DIRECT":
-            send_to_hardware(value, add_newline=False)
-            variables[var_name] = value
-        elif tag == "SHELL":
-            prefix = ansi_prefix()
-            if prefix:
-                print(f"{prefix}{value}{ansi_reset()}", end="")
-            else:
-                print(value, end="")
-            variables[var_name] = value
-        else:
-            print(f"[WARN] Unknown DisplayTextRaw tag '{tag}', defaulting to SHELL")
-            print(value, end="")
-            variables[var_name] = value
-        return
+        return (handle_set_display_raw, (var_name,) + display_args(dtr_match))
 
     # Fallback: normal value or variable reference
     if raw_value.startswith('"') and raw_value.endswith('"'):
-        variables[var_name] = substitute_variables(raw_value.strip('"'))
-    else:
-        variables[var_name] = parse_value(raw_value)
+        return handle_set_text, (var_name, split_template(raw_value.strip('"')))
+    return handle_set_value, (var_name, sys.intern(raw_value))
+
+def handle_set_math(var_name, expr):
+    try:
+        result = eval_math(expr)
+        variables[var_name] = str(result)
+    except Exception as e:
+        print(f"[ERROR] Math evaluation failed: {e}")
+
+def handle_set_read_file(var_name, path_token):
+    file_path = parse_path_token(path_token)
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            variables[var_name] = f.read()
+    except Exception as e:
+        print(f"[ERROR] ReadFile failed: {e}")
+
+def handle_set_fs_read(var_name, path_token):
+    file_path = fs_normalize_path(parse_path_token(path_token))
+    variables[var_name] = fs_read_file(file_path)
+    variables["LASTREADPATH"] = file_path
+    variables["LASTREAD"] = variables[var_name]
+    variables["LASTREADSIZE"] = str(len(variables[var_name]))
+
+def handle_set_fs_list(var_name, path_token):
+    list_path = fs_normalize_path(parse_path_token(path_token))
+    entries = fs_list_dir(list_path)
+    variables[var_name] = ",".join(entries)
+    variables["LASTLISTPATH"] = list_path
+    variables["LASTLIST"] = variables[var_name]
+    variables["LASTLISTCOUNT"] = str(len(entries))
+
+def handle_set_block_alloc(var_name):
+    block_id = str(fs_alloc_block())
+    variables[var_name] = block_id
+    variables["LASTBLOCK"] = block_id
+
+def handle_set_block_read(var_name, id_token):
+    block_id = parse_token_value(id_token)
+    variables[var_name] = fs_read_block(block_id)
+    variables["LASTBLOCK"] = str(block_id)
+
+def handle_set_display(var_name, tag, template):
+    # Same output as a plain DisplayText line; the shown text is also stored
+    variables[var_name] = handle_display(tag, template)
+
+def handle_set_display_raw(var_name, tag, template):
+    variables[var_name] = handle_display_raw(tag, template)
+
+def handle_set_text(var_name, template):
+    variables[var_name] = render_template(template)
+
+def handle_set_value(var_name, raw_value):
+    variables[var_name] = variables.get(raw_value, raw_value)
 
 
-def handle_display(line):
+def parse_display(line):
     # line format: DisplayText(TAG)=<content>
-    match = re.match(r"DisplayText\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$", line)
+    if not (line.startswith("DisplayText(DIRECT)=") or line.startswith("DisplayText(SHELL)=")):
+        return report_unknown_command, (line,)
+    match = DISPLAY_TEXT_RE.match(line)
     if not match:
-        print(f"[ERROR] Invalid DisplayText syntax (must be quoted): {line}")
-        return
+        return report_error, (f"[ERROR] Invalid DisplayText syntax (must be quoted): {line}",)
+    tag, template = display_args(match)
+    if tag == "SHELL":
+        # The common case gets its own op; text without <`VAR`> is printed as is.
+        if len(template) == 1:
+            return display_to_shell, template
+        return handle_display_shell, (template,)
+    return handle_display, (tag, template)
+
+def handle_display_shell(template):
+    display_to_shell(render_template(template))
 
-    tag = match.group(1).strip().upper()
-    content = match.group(3).strip()
-    content = substitute_variables(content)
+def display_args(match):
+    """(tag, template) from a DISPLAY_TEXT_RE / DISPLAY_TEXT_RAW_RE match."""
+    return match.group(1).strip().upper(), split_template(match.group(3).strip())
+
+def handle_display(tag, template):
+    content = render_template(template)
 
     if tag == "SHELL":
         display_to_shell(content)
@@ -633,21 +872,24 @@ def handle_display(line):
     else:
         print(f"[WARN] Unknown DisplayText tag '{tag}', defaulting to SHELL")
         display_to_shell(content)
+    return content
 
-def handle_display_raw(line):
+def parse_display_raw(line):
     # line format: DisplayTextRaw(TAG)=<content>
-    match = re.match(r"DisplayTextRaw\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$", line)
+    if not (line.startswith("DisplayTextRaw(DIRECT)=") or line.startswith("DisplayTextRaw(SHELL)=")):
+        return report_unknown_command, (line,)
+    match = DISPLAY_TEXT_RAW_RE.match(line)
     if not match:
-        print(f"[ERROR] Invalid DisplayTextRaw syntax (must be quoted): {line}")
-        return
-    tag = match.group(1).strip().upper()
-    content = match.group(3).strip()
-    content = substitute_variables(content)
+        return report_error, (f"[ERROR] Invalid DisplayTextRaw syntax (must be quoted): {line}",)
+    return handle_display_raw, display_args(match)
+
+def handle_display_raw(tag, template):
+    content = render_template(template)
 
     if tag == "SHELL":
-        prefix = ansi_prefix()
+        prefix = current_ansi
         if prefix:
-            print(f"{prefix}{content}{ansi_reset()}", end="")
+            print(f"{prefix}{content}{ANSI_RESET}", end="")
         else:
             print(content, end="")
     elif tag == "DIRECT":
@@ -655,99 +897,86 @@ def handle_display_raw(line):
     else:
         print(f"[WARN] Unknown DisplayTextRaw tag '{tag}', defaulting to SHELL")
         print(content, end="")
+    return content
 
-def handle_fs_command(line):
-    create_match = re.match(r"FS\[Create\]\[(.*?)\]\s*(?:=\s*(.*))?$", line)
-    if create_match:
-        file_path = fs_normalize_path(parse_path_token(create_match.group(1)))
-        meta_raw = parse_token_value(create_match.group(2)) if create_match.group(2) else ""
-        meta = fs_parse_meta(meta_raw)
-        if fs_get_file(file_path) is not None:
-            print(f"[ERROR] File '{file_path}' already exists.")
-            return True
-        fs_create_file(file_path, meta)
-        variables["LASTCREATEPATH"] = file_path
-        fs_save()
-        return True
-
-    read_match = re.match(r"FS\[Read\]\[(.*?)\]\s*$", line)
-    if read_match:
-        file_path = fs_normalize_path(parse_path_token(read_match.group(1)))
-        content = fs_read_file(file_path)
-        variables["LASTREADPATH"] = file_path
-        variables["LASTREAD"] = content
-        variables["LASTREADSIZE"] = str(len(content))
-        fs_save()
-        return True
-
-    write_match = re.match(r"FS\[Write\]\[(.*?)\]\s*=\s*(.*)$", line)
-    if write_match:
-        file_path = fs_normalize_path(parse_path_token(write_match.group(1)))
-        content = parse_token_value(write_match.group(2))
-        fs_write_file(file_path, content)
-        variables["LASTWRITEPATH"] = file_path
-        variables["LASTWRITESIZE"] = str(len(content))
-        fs_save()
-        return True
-
-    list_match = re.match(r"FS\[List\](?:\[(.*?)\])?\s*$", line)
-    if list_match:
-        list_path = fs_normalize_path(parse_path_token(list_match.group(1)))
-        entries = fs_list_dir(list_path)
-        variables["LASTLISTPATH"] = list_path
-        variables["LASTLIST"] = ",".join(entries)
-        variables["LASTLISTCOUNT"] = str(len(entries))
-        fs_save()
-        return True
-
-    role_match = re.match(r"FS\[SetRole\]\[(.*?)\]\s*=\s*(.*)$", line)
-    if role_match:
-        file_path = fs_normalize_path(parse_path_token(role_match.group(1)))
-        role = parse_token_value(role_match.group(2))
-        if fs_set_role(file_path, role):
-            variables["LASTROLEPATH"] = file_path
-            variables["LASTROLE"] = role
-            fs_save()
-        return True
-
-    tran_match = re.match(r"FS\[Tran\]\[(.*?)\]\s*$", line)
-    if tran_match:
-        file_path = fs_normalize_path(parse_path_token(tran_match.group(1)))
-        if fs_tran(file_path):
-            variables["LASTROLEPATH"] = file_path
-            variables["LASTROLE"] = "Tran"
-            fs_save()
-        return True
-
-    return False
-
-def handle_block_command(line):
-    alloc_match = re.match(r"Block\[Alloc\]\s*$", line)
-    if alloc_match:
-        block_id = fs_alloc_block()
-        variables["LASTBLOCK"] = block_id
-        fs_save()
-        return True
-
-    read_match = re.match(r"Block\[Read\]\[(.*?)\]\s*$", line)
-    if read_match:
-        block_id = parse_token_value(read_match.group(1))
-        content = fs_read_block(block_id)
+def parse_fs_command(line):
+    fs_load()
+    # The op name in FS[<Op>] picks the single pattern that can match.
+    entry = FS_COMMANDS.get(line[3:line.find("]")])
+    if entry is None:
+        return NOP
+    pattern, handler = entry
+    match = pattern.match(line)
+    return (handler, match.groups()) if match else NOP
+
+def handle_fs_create(path_token, meta_token):
+    file_path = fs_normalize_path(parse_path_token(path_token))
+    meta_raw = parse_token_value(meta_token) if meta_token else ""
+    meta = fs_parse_meta(meta_raw)
+    if fs_get_file(file_path) is not None:
+        print(f"[ERROR] File '{file_path}' already exists.")
+        return
+    fs_create_file(file_path, meta)
+    variables["LASTCREATEPATH"] = file_path
+
+def handle_fs_read(path_token):
+    file_path = fs_normalize_path(parse_path_token(path_token))
+    content = fs_read_file(file_path)
+    variables["LASTREADPATH"] = file_path
+    variables["LASTREAD"] = content
+    variables["LASTREADSIZE"] = str(len(content))
+
+def handle_fs_write(path_token, content_token):
+    file_path = fs_normalize_path(parse_path_token(path_token))
+    content = parse_token_value(content_token)
+    fs_write_file(file_path, content)
+    variables["LASTWRITEPATH"] = file_path
+    variables["LASTWRITESIZE"] = str(len(content))
+
+def handle_fs_list(path_token):
+    list_path = fs_normalize_path(parse_path_token(path_token))
+    entries = fs_list_dir(list_path)
+    variables["LASTLISTPATH"] = list_path
+    variables["LASTLIST"] = ",".join(entries)
+    variables["LASTLISTCOUNT"] = str(len(entries))
+
+def handle_fs_set_role(path_token, role_token):
+    file_path = fs_normalize_path(parse_path_token(path_token))
+    role = parse_token_value(role_token)
+    if fs_set_role(file_path, role):
+        variables["LASTROLEPATH"] = file_path
+        variables["LASTROLE"] = role
+
+def handle_fs_tran(path_token):
+    file_path = fs_normalize_path(parse_path_token(path_token))
+    if fs_tran(file_path):
+        variables["LASTROLEPATH"] = file_path
+        variables["LASTROLE"] = "Tran"
+
+def parse_block_command(line):
+    fs_load()
+    entry = BLOCK_COMMANDS.get(line[6:line.find("]")])
+    if entry is None:
+        return NOP
+    pattern, handler = entry
+    match = pattern.match(line)
+    return (handler, match.groups()) if match else NOP
+
+def handle_block_alloc():
+    block_id = str(fs_alloc_block())
+    variables["LASTBLOCK"] = block_id
+
+def handle_block_read(id_token):
+    block_id = parse_token_value(id_token)
+    content = fs_read_block(block_id)
+    variables["LASTBLOCK"] = str(block_id)
+    variables["LASTBLOCKDATA"] = content
+
+def handle_block_write(id_token, content_token):
+    block_id = parse_token_value(id_token)
+    content = parse_token_value(content_token)
+    if fs_write_block(block_id, content):
         variables["LASTBLOCK"] = str(block_id)
-        variables["LASTBLOCKDATA"] = content
-        fs_save()
-        return True
-
-    write_match = re.match(r"Block\[Write\]\[(.*?)\]\s*=\s*(.*)$", line)
-    if write_match:
-        block_id = parse_token_value(write_match.group(1))
-        content = parse_token_value(write_match.group(2))
-        if fs_write_block(block_id, content):
-            variables["LASTBLOCK"] = str(block_id)
-            fs_save()
-        return True
-
-    return False
 
 def handle_input():
     user_input = input("> ").strip()
@@ -782,39 +1011,35 @@ def handle_input_noblock():
         variables["INPUT"] = ""
         set_word_vars("")
 
-IF_OP_RE = re.compile(r"If\[(.*?)\]\s*(>=|<=|=|>|<)\s*(.+)$")
 
 def parse_uint_like_vm(value):
+    """Leading ASCII digits of value as an int, 0 if there are none (as the VM reads numbers)."""
     s = str(value).strip()
-    acc = 0
-    for ch in s:
-        if ch < '0' or ch > '9':
-            break
-        acc = acc * 10 + (ord(ch) - ord('0'))
-    return acc
+    if s.isdigit() and s.isascii():
+        return int(s)
+    digits = UINT_PREFIX_RE.match(s).group(0)
+    return int(digits) if digits else 0
 
 def parse_if_parts(line):
     match = IF_OP_RE.match(line)
     if not match:
         return None
-    left = match.group(1).strip()
+    left = sys.intern(match.group(1).strip())
     op = match.group(2)
-    right_raw = match.group(3).strip()
-    if (right_raw.startswith('"') and right_raw.endswith('"')) or (right_raw.startswith("'") and right_raw.endswith("'")):
-        right = right_raw[1:-1]
-        right_is_var = False
+    right = match.group(3).strip()
+    quoted = (right.startswith('"') and right.endswith('"')) or (right.startswith("'") and right.endswith("'"))
+    if quoted:
+        right = right[1:-1]
     else:
-        right = right_raw
-        right_is_var = right in variables
-    return left, op, right, right_is_var
+        right = sys.intern(right)
+    return left, op, right, quoted
 
-def handle_if(line):
+def handle_if(left, op, right, quoted):
     try:
-        parsed = parse_if_parts(line)
-        if not parsed:
-            print(f"[ERROR] Invalid If condition: '{line}'. Expected format: If[VAR] OP VALUE")
-            return False
-        left, op, right, right_is_var = parsed
+        if quoted:
+            right_is_var = False
+        else:
+            right_is_var = right in variables
         left_val = variables.get(left, "").strip()
         right_val = variables.get(right, "").strip() if right_is_var else right
 
@@ -835,337 +1060,401 @@ def handle_if(line):
         print(f"[ERROR] Failed to parse If condition: {e}")
         return False
 
-def skip_if_block(start_index):
-    """Skip to matching Else or EndIf for the If at start_index.
-    Supports nested If/EndIf pairs.
-    Returns the index of Else or EndIf (or len(program_lines) if not found).
-    """
-    depth = 0
-    i = start_index + 1
-    while i < len(program_lines):
-        l = program_lines[i].strip()
-        if IF_OP_RE.match(l):
-            depth += 1
-        elif l == "EndIf":
-            if depth == 0:
-                return i
-            depth -= 1
-        elif l == "Else" and depth == 0:
-            return i
-        i += 1
-    return i
-
-def skip_to_endif(start_index):
-    """Skip from an Else line to its matching EndIf."""
-    depth = 0
-    i = start_index + 1
-    while i < len(program_lines):
-        l = program_lines[i].strip()
-        if IF_OP_RE.match(l):
-            depth += 1
-        elif l == "EndIf":
-            if depth == 0:
-                return i
-            depth -= 1
-        i += 1
-    return i
-
-
-def handle_loop(start_index):
-    global current_line
-    loop_lines = []
-    i = start_index + 1
-    while i < len(program_lines) and not program_lines[i].strip().startswith("EndLoop"):
-        loop_lines.append(program_lines[i])
-        i += 1
-    while True:
-        for line in loop_lines:
-            execute_line(line)
-    current_line = i  # Will never reach this due to infinite loop
-
-def handle_goto(label):
+def handle_jump(target):
     global current_line
-    if label in labels:
-        current_line = labels[label]
+    # run_program increments after this returns, landing on target + 1
+    current_line = target
+
+def handle_call(code):
+    global program_code, current_line
+    # Execute function body in its own line context so If/Else skips don't
+    # mutate the main program flow.
+    saved_program_code = program_code
+    saved_current_line = current_line
+    try:
+        program_code = code
+        end = len(code)
+        current_line = 0
+        while current_line < end:
+            handler, args = code[current_line]
+            handler(*args)
+            current_line += 1
+    finally:
+        program_code = saved_program_code
+        current_line = saved_current_line
+
+def parse_write_file(line):
+    match = WRITE_FILE_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid WriteFile syntax: {line}",)
+    return handle_write_file, (match.group(1), match.group(2))
+
+def handle_write_file(path_token, rhs):
+    if path_token is None and rhs is not None:
+        # Allow: WriteFile= "path"
+        file_path = parse_path_token(rhs)
+        content = ""
     else:
-        print(f"[ERROR] Label '{label}' not found.")
-        sys.exit(1)
+        file_path = parse_path_token(path_token)
+        content = parse_token_value(rhs)
+    try:
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(content)
+    except Exception as e:
+        print(f"[ERROR] WriteFile failed: {e}")
 
-def handle_call(func_name):
-    if func_name not in functions:
-        print(f"[ERROR] Function '{func_name}' not found.")
-        return
-    for line in functions[func_name]:
-        execute_line(line)
+def parse_append_file(line):
+    match = APPEND_FILE_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid AppendFile syntax: {line}",)
+    return handle_append_file, (match.group(1), match.group(2))
 
-# ------------------------------
-# Interpreter
-# ------------------------------
-def execute_line(line):
+def handle_append_file(path_token, content_token):
+    file_path = parse_path_token(path_token)
+    content = parse_token_value(content_token)
+    try:
+        with open(file_path, "a", encoding="utf-8") as f:
+            f.write(content)
+    except Exception as e:
+        print(f"[ERROR] AppendFile failed: {e}")
+
+def parse_track_input(line):
+    if not line.startswith("TrackInput[KEYBOARD]"):
+        return report_unknown_command, (line,)
+    if TRACK_INPUT_INSTANT_RE.match(line):
+        return handle_input_instant, ()
+    if TRACK_INPUT_NOBLOCK_RE.match(line):
+        return handle_input_noblock, ()
+    return handle_input, ()
+
+def parse_if(line):
+    parsed = parse_if_parts(line)
+    if not parsed:
+        return report_unknown_command, (line,)
+    return handle_if_line, parsed
+
+def handle_if_line(left, op, right, quoted, false_target):
     global current_line
+    if not handle_if(left, op, right, quoted):
+        # Land on the matching Else/EndIf; run_program steps past it.
+        current_line = false_target
+
+def parse_loop(line):
+    if not line.startswith("Loop[FOREVER]"):
+        return report_unknown_command, (line,)
+    return NOP  # The matching EndLoop jumps back here, see parse_program_lines
+
+def parse_goto(line):
+    label = bracket_arg(line, 5)
+    if label not in labels:
+        # Rejected at load time, before any line runs.
+        print(f"[ERROR] Label '{label}' not found.")
+        sys.exit(1)
+    return handle_jump, (labels[label],)
 
-    line = line.strip()
-    line = strip_inline_comment(line)
-    if not line or line.startswith("//"):
-        return  
-
-    # Structural-only keywords: tolerate optional spaces in the bit declaration
-    if line.replace(" ", "") in ("[16BIT]", "startprogram", "endprogram", "startsection", "endsection"):
-        return
-
-    if line.startswith("Set["):
-        handle_set(line)
+def parse_call(line):
+    func_name = bracket_arg(line, 13)
+    if func_name not in function_code:
+        return report_error, (f"[ERROR] Function '{func_name}' not found.",)
+    return handle_call, (function_code[func_name],)
 
-    elif line.startswith("DisplayTextRaw(DIRECT)=") or line.startswith("DisplayTextRaw(SHELL)="):
-        handle_display_raw(line)
+def parse_set_color(line):
+    match = SET_COLOR_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid SetColor syntax: {line}",)
+    return handle_set_color, (match.group(1).upper(), match.group(2))
 
-    elif line.startswith("DisplayText(DIRECT)=") or line.startswith("DisplayText(SHELL)="):
-        handle_display(line)
+def handle_set_color(tag, value_token):
+    set_color(tag, parse_token_value(value_token))
 
-    elif line.startswith("FS["):
-        if handle_fs_command(line):
-            return
+def parse_draw_box(line):
+    match = DRAW_BOX_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid DrawBox syntax: {line}",)
+    return handle_draw_box, (match.group(1), match.group(2), match.group(3))
 
-    elif line.startswith("Block["):
-        if handle_block_command(line):
-            return
+def handle_draw_box(width, height, ch_token):
+    draw_box(width, height, parse_token_value(ch_token))
 
-    elif line.startswith("WriteFile"):
-        match = re.match(r"WriteFile(?:\[(.*?)\])?\s*(?:=\s*(.*))?$", line)
-        if not match:
-            print(f"[ERROR] Invalid WriteFile syntax: {line}")
-            return
-        path_token = match.group(1)
-        rhs = match.group(2)
-        if path_token is None and rhs is not None:
-            # Allow: WriteFile= "path"
-            file_path = parse_path_token(rhs)
-            content = ""
-        else:
-            file_path = parse_path_token(path_token)
-            content = parse_token_value(rhs)
-        try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content)
-        except Exception as e:
-            print(f"[ERROR] WriteFile failed: {e}")
+# How long a terminal width query is trusted before asking the tty again.
+TERMINAL_COLS_TTL = 0.25
 
-    elif line.startswith("AppendFile"):
-        match = re.match(r"AppendFile\[(.*?)\]\s*=\s*(.*)$", line)
-        if not match:
-            print(f"[ERROR] Invalid AppendFile syntax: {line}")
-            return
-        file_path = parse_path_token(match.group(1))
-        content = parse_token_value(match.group(2))
+def terminal_columns():
+    """Terminal width for FillLine/FillLines, re-queried at most every TERMINAL_COLS_TTL seconds."""
+    global terminal_cols, terminal_cols_checked
+    now = time.monotonic()
+    if terminal_cols is None or now - terminal_cols_checked >= TERMINAL_COLS_TTL:
         try:
-            with open(file_path, "a", encoding="utf-8") as f:
-                f.write(content)
-        except Exception as e:
-            print(f"[ERROR] AppendFile failed: {e}")
+            terminal_cols = shutil.get_terminal_size((80, 20)).columns
+        except Exception:
+            terminal_cols = 80
+        terminal_cols_checked = now
+    return terminal_cols
 
-    elif line.startswith("TrackInput[KEYBOARD]"):
-        if re.match(r"TrackInput\[\s*KEYBOARD\s*\]\s*=\s*INSTANT\s*$", line, flags=re.IGNORECASE):
-            handle_input_instant()
-        elif re.match(r"TrackInput\[\s*KEYBOARD\s*\]\s*=\s*NOBLOCK\s*$", line, flags=re.IGNORECASE):
-            handle_input_noblock()
-        else:
-            handle_input()
+def handle_fill_line():
+    text = " " * max(1, terminal_columns())
+    print(f"{current_ansi}{text}{ANSI_RESET}\r", end="")
 
-    elif IF_OP_RE.match(line):
-        if not handle_if(line):
-            current_line = skip_if_block(current_line)
-            if current_line < len(program_lines):
-                if program_lines[current_line].strip() in ("Else", "EndIf"):
-                    return
+def parse_fill_lines(line):
+    if not line.endswith("]"):
+        return report_unknown_command, (line,)
+    return handle_fill_lines, (line, line[10:-1])
 
-    elif line == "Else":
-        current_line = skip_to_endif(current_line)
+def handle_fill_lines(line, raw_count):
+    try:
+        count = int(parse_token_value(raw_count))
+    except Exception:
+        print(f"[ERROR] Invalid FillLines syntax: {line}")
         return
-
-    elif line == "EndIf":
+    if count <= 0:
         return
+    text = " " * max(1, terminal_columns())
+    if current_ansi:
+        text = f"{current_ansi}{text}{ANSI_RESET}"
+    # One write for the whole fill instead of two prints per line.
+    print("\n".join([text] * count) + "\r", end="")
+
+def parse_set_cursor(line):
+    match = SET_CURSOR_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid SetCursor syntax: {line}",)
+    return handle_set_cursor, (match.group(1), match.group(2))
 
-    elif line.startswith("Loop[FOREVER]"):
-        handle_loop(current_line)
-
-    elif line.startswith("Goto["):
-        label = line.split("Goto[", 1)[1].split("]", 1)[0]
-        handle_goto(label)
-
-    elif line.startswith("CallFunction["):
-        func = line.split("CallFunction[", 1)[1].split("]", 1)[0]
-        handle_call(func)
-
-    elif line.startswith("SetColor["):
-        match = re.match(r"SetColor\[(FG|BG)\]\s*=\s*(.*)$", line, re.IGNORECASE)
-        if not match:
-            print(f"[ERROR] Invalid SetColor syntax: {line}")
-            return
-        tag = match.group(1).upper()
-        value = parse_token_value(match.group(2))
-        set_color(tag, value)
-
-    elif line == "ResetColor":
-        reset_color()
+def handle_set_cursor(row_token, col_token):
+    row = parse_token_value(row_token)
+    col = parse_token_value(col_token)
+    try:
+        set_cursor(int(row), int(col))
+    except ValueError:
+        print("[ERROR] SetCursor requires integer row and column")
 
-    elif line.startswith("DrawBox["):
-        match = re.match(r"DrawBox\[(\d+)\s*,\s*(\d+)\]\s*=\s*(.*)$", line)
-        if not match:
-            print(f"[ERROR] Invalid DrawBox syntax: {line}")
-            return
-        width = match.group(1)
-        height = match.group(2)
-        ch = parse_token_value(match.group(3))
-        draw_box(width, height, ch)
+def parse_tick_timer(line):
+    match = TICK_TIMER_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid TickTimer syntax: {line}",)
+    return handle_tick_timer, (match.group(1),)
 
-    elif line == "ClearScreen":
-        clear_screen()
+def handle_tick_timer(ms_token):
+    tick_timer(parse_token_value(ms_token))
 
-    elif line == "FillLine":
-        try:
-            import shutil
-            cols = shutil.get_terminal_size((80, 20)).columns
-        except Exception:
-            cols = 80
-        text = " " * max(1, cols)
-        print(f"{ansi_prefix()}{text}{ansi_reset()}", end="")
-        print("\r", end="")
+def parse_time(line):
+    match = TIME_RE.match(line)
+    if not match:
+        return report_error, (f"[ERROR] Invalid Time syntax: {line}",)
+    return handle_time, (match.group(1).upper(), match.group(2))
+
+def handle_time(unit, value_token):
+    value = parse_token_value(value_token)
+    if unit == "MS":
+        tick_timer(value)
+    elif unit == "SEC":
+        tick_timer_seconds(value)
+    elif unit == "MIN":
+        tick_timer_minutes(value)
+
+def parse_label(line):
+    if "]" not in line:
+        return report_unknown_command, (line,)
+    return NOP  # Already stored
 
-    elif line.startswith("FillLines[") and line.endswith("]"):
-        try:
-            raw_count = line.split("FillLines[", 1)[1][:-1]
-            count = int(parse_token_value(raw_count))
-        except Exception:
-            print(f"[ERROR] Invalid FillLines syntax: {line}")
-            return
-        if count <= 0:
-            return
-        try:
-            import shutil
-            cols = shutil.get_terminal_size((80, 20)).columns
-        except Exception:
-            cols = 80
-        text = " " * max(1, cols)
-        prefix = ansi_prefix()
-        for i in range(count):
-            if prefix:
-                print(f"{prefix}{text}{ansi_reset()}", end="")
-            else:
-                print(text, end="")
-            if i < count - 1:
-                print()
-        print("\r", end="")
+# ------------------------------
+# Interpreter
+# ------------------------------
+# FS[<Op>] and Block[<Op>] commands: op name -> (pattern, handler). The
+# pattern's groups are the handler's arguments.
+FS_COMMANDS = {
+    "Create": (FS_CREATE_RE, handle_fs_create),
+    "Read": (FS_READ_RE, handle_fs_read),
+    "Write": (FS_WRITE_RE, handle_fs_write),
+    "List": (FS_LIST_RE, handle_fs_list),
+    "SetRole": (FS_SET_ROLE_RE, handle_fs_set_role),
+    "Tran": (FS_TRAN_RE, handle_fs_tran),
+}
+
+BLOCK_COMMANDS = {
+    "Alloc": (BLOCK_ALLOC_RE, handle_block_alloc),
+    "Read": (BLOCK_READ_RE, handle_block_read),
+    "Write": (BLOCK_WRITE_RE, handle_block_write),
+}
+
+# Keyed by the command head: everything up to and including the first '[' or
+# '(' (or the whole line for bare commands), see COMMAND_HEAD_RE. Each parser
+# turns a source line into a (handler, args) op.
+COMMAND_PARSERS = {
+    "Set[": parse_set,
+    "DisplayText(": parse_display,
+    "DisplayTextRaw(": parse_display_raw,
+    "FS[": parse_fs_command,
+    "Block[": parse_block_command,
+    "WriteFile[": parse_write_file,
+    "AppendFile[": parse_append_file,
+    "TrackInput[": parse_track_input,
+    "If[": parse_if,
+    # If and Else get their jump targets in parse_program_lines
+    "Else": lambda line: NOP,
+    "EndIf": lambda line: NOP,
+    "Loop[": parse_loop,
+    "Goto[": parse_goto,
+    "CallFunction[": parse_call,
+    "SetColor[": parse_set_color,
+    "ResetColor": lambda line: (reset_color, ()),
+    "DrawBox[": parse_draw_box,
+    "ClearScreen": lambda line: (clear_screen, ()),
+    "FillLine": lambda line: (handle_fill_line, ()),
+    "FillLines[": parse_fill_lines,
+    "SetCursor[": parse_set_cursor,
+    "TickTimer[": parse_tick_timer,
+    "Time[": parse_time,
+    # Already handled in preload
+    "StartFunction[": lambda line: NOP,
+    "EndFunction": lambda line: NOP,
+    "Label[": parse_label,
+}
+
+def parse_line(line):
+    """Turn one source line into a (handler, args) op; run it with handler(*args).
+    Lines come from load_program already stripped, comment-free and with
+    structural keywords removed.
+    """
+    parser = COMMAND_PARSERS.get(COMMAND_HEAD_RE.match(line).group(0))
+    if parser is not None:
+        return parser(line)
 
-    elif line.startswith("SetCursor["):
-        match = re.match(r"SetCursor\[(.*?)\s*,\s*(.*?)\]\s*$", line)
-        if not match:
-            print(f"[ERROR] Invalid SetCursor syntax: {line}")
-            return
-        row = parse_token_value(match.group(1))
-        col = parse_token_value(match.group(2))
-        try:
-            set_cursor(int(row), int(col))
-        except ValueError:
-            print("[ERROR] SetCursor requires integer row and column")
+    # Forms without a bracketed head, e.g. 'WriteFile= "path"'
+    if line.startswith("WriteFile"):
+        return parse_write_file(line)
 
-    elif line.startswith("TickTimer["):
-        match = re.match(r"TickTimer\[(.*?)\]\s*$", line)
-        if not match:
-            print(f"[ERROR] Invalid TickTimer syntax: {line}")
-            return
-        ms = parse_token_value(match.group(1))
-        tick_timer(ms)
+    if line.startswith("AppendFile"):
+        return parse_append_file(line)
 
-    elif line.startswith("Time["):
-        match = re.match(r"Time\[(MS|SEC|MIN)\]\s*=\s*(.*)$", line, re.IGNORECASE)
-        if not match:
-            print(f"[ERROR] Invalid Time syntax: {line}")
-            return
-        unit = match.group(1).upper()
-        value = parse_token_value(match.group(2))
-        if unit == "MS":
-            tick_timer(value)
-        elif unit == "SEC":
-            tick_timer_seconds(value)
-        elif unit == "MIN":
-            tick_timer_minutes(value)
-
-    elif line.startswith("StartFunction[") or line == "EndFunction":
-        return  # Already handled in preload
-
-    elif line.startswith("Label[") and "]" in line:
-        return  # Already stored
-    elif line.startswith("Label:"):
+    if line.startswith("Label:"):
         # backward compatibility: warn and ignore at runtime
-        print("[WARN] Deprecated label syntax 'Label:NAME' used; prefer 'Label[NAME]'")
-        return  # Already stored
+        return report_error, ("[WARN] Deprecated label syntax 'Label:NAME' used; prefer 'Label[NAME]'",)
 
-    else:
-        print(f"[ERROR] Unknown command: {line}")
+    return report_unknown_command, (line,)
+
+def parse_program_lines(lines):
+    """Parse a block of lines into ops and link its jumps: a false If goes to
+    its matching Else/EndIf, a reached Else skips to its EndIf, and each
+    EndLoop jumps back to its Loop[FOREVER] line.
+    """
+    code = [parse_line(line) for line in lines]
+    loop_stack = []
+    # If nesting depth -> [(index, is_else)] still looking for a target. An If
+    # stops at the first Else or EndIf at its own depth, an Else at the EndIf;
+    # anything left open jumps past the end of the block.
+    waiting = {}
+    depth = 0
+    targets = {}
+    for index, line in enumerate(lines):
+        if IF_OP_RE.match(line):
+            depth += 1
+            waiting.setdefault(depth, []).append((index, False))
+        elif line == "Else":
+            pending = waiting.get(depth, [])
+            for pos, is_else in pending:
+                if not is_else:
+                    targets[pos] = index
+            waiting[depth] = [entry for entry in pending if entry[1]] + [(index, True)]
+        elif line == "EndIf":
+            for pos, _ in waiting.pop(depth, []):
+                targets[pos] = index
+            depth -= 1
+        elif line.startswith("Loop[FOREVER]"):
+            loop_stack.append(index)
+        elif line == "EndLoop" and loop_stack:
+            code[index] = (handle_jump, (loop_stack.pop(),))
+    for pending in waiting.values():
+        for pos, _ in pending:
+            targets[pos] = len(lines)
+    for pos, target in targets.items():
+        if lines[pos] == "Else":
+            code[pos] = (handle_jump, (target,))
+        else:
+            handler, args = code[pos]
+            code[pos] = (handler, args + (target,))
+    return code
 
 # ------------------------------
 # Program Loader (First Pass)
 # ------------------------------
-def load_program(file_path):
-    global program_lines, labels, functions
-
-    with open(file_path, "r") as f:
-        raw_lines = f.readlines()
+def scan_source(file_path, encoding=None):
+    """Read a program and split it into (main_lines, functions).
 
-    in_function = False
-    current_func = ""
-
-    # We'll build a filtered program_lines that excludes function bodies so they are
-    # not executed during the main run. Labels must be indexed against the filtered list.
-    program_lines = []
-    labels = {}
+    Lines come back stripped, with comments, blank lines and structural
+    keywords removed; functions maps each StartFunction[NAME] to its body.
+    """
+    # One read for the whole file. Splitting on "\n" matches what readlines()
+    # produced (str.splitlines() would also break on \f, \v and friends).
+    with open(file_path, "r", encoding=encoding) as f:
+        raw_lines = f.read().split("\n")
+
+    # Strip whitespace and inline comments, then drop empty, comment-only and
+    # structural-keyword lines in one pass.
+    lines = [strip_inline_comment(line.strip()) for line in raw_lines]
+    lines = [
+        line for line in lines
+        if line and not line.startswith("//") and not is_structural(line)
+    ]
+
+    # The main program excludes function bodies so they are not executed
+    # during the main run. Everything between a StartFunction[NAME] and the
+    # next EndFunction is sliced out as that function's body.
+    main_lines = []
     functions = {}
+    body = main_lines
+    start = 0
+    for index, line in enumerate(lines):
+        if line.startswith("StartFunction["):
+            body.extend(lines[start:index])
+            func_name = bracket_arg(line, 14)
+            functions[func_name] = body = []
+            start = index + 1
+        elif line == "EndFunction":
+            body.extend(lines[start:index])
+            body = main_lines
+            start = index + 1
+    body.extend(lines[start:])
+    return main_lines, functions
 
-    for line in raw_lines:
-        stripped = line.strip()
-        stripped = strip_inline_comment(stripped)
-        if not stripped or stripped.startswith("//"):
-            continue
-
-        if stripped.startswith("StartFunction["):
-            in_function = True
-            current_func = stripped.split("StartFunction[", 1)[1].split("]", 1)[0]
-            functions[current_func] = []
-            continue
-
-        if stripped == "EndFunction":
-            in_function = False
-            current_func = ""
-            continue
+def load_program(file_path):
+    global program_lines, program_code, labels, functions, function_code
 
-        if in_function:
-            # collect function body lines (already stripped)
-            if stripped and not stripped.startswith("//"):
-                functions[current_func].append(stripped)
-            continue
+    program_lines, functions = scan_source(file_path)
 
-        # Not inside a function: treat as part of the main program
-        # New preferred syntax: Label[NAME]
-        if stripped.startswith("Label[") and "]" in stripped:
-            label_name = stripped.split("Label[", 1)[1].split("]", 1)[0].strip()
-            labels[label_name] = len(program_lines)
-        elif stripped.startswith("Label:"):
-            # Backwards compatibility: accept old form but warn
-            label_name = stripped[6:].strip()
-            print(f"[WARN] Deprecated label syntax 'Label:NAME' used for '{label_name}'; prefer 'Label[{label_name}]'")
-            labels[label_name] = len(program_lines)
+    # Labels must be indexed against the filtered list.
+    labels = {}
+    for index, line in enumerate(program_lines):
+        match = LABEL_RE.match(line)
+        if match:
+            bracketed, legacy = match.groups()
+            label_name = (bracketed if bracketed is not None else legacy).strip()
+            if bracketed is None:
+                # Backwards compatibility: accept old form but warn
+                print(f"[WARN] Deprecated label syntax 'Label:NAME' used for '{label_name}'; prefer 'Label[{label_name}]'")
+            labels[label_name] = index
 
-        program_lines.append(stripped)
+    # Parse every line once up front so the runner only dispatches ops.
+    # Function op lists exist before anything is parsed so CallFunction ops can
+    # hold them directly, even for later or recursive definitions.
+    function_code = {name: [] for name in functions}
+    for name, body in functions.items():
+        function_code[name].extend(parse_program_lines(body))
+    program_code = parse_program_lines(program_lines)
 
 # ------------------------------
 # Runner
 # ------------------------------
 def run_program():
     global current_line
+    # handle_call swaps program_code but restores it before returning, so the
+    # main program's op list can be held in a local for the whole run.
+    code = program_code
+    end = len(code)
     current_line = 0
-    while current_line < len(program_lines):
-        line = program_lines[current_line].strip()
-        execute_line(line)
+    while current_line < end:
+        handler, args = code[current_line]
+        handler(*args)
         current_line += 1
 
 # ------------------------------
@@ -1185,14 +1474,92 @@ MOV_AL = b"\xB0"  # followed by imm8
 INT_10 = b"\xCD\x10"
 JMP_LOOP = b"\xEB\xFE"
 
+# Stage2 is loaded at 0x0000:0x8000 and runs with DS=0, so the VM, its
+# bytecode and all data must fit in the rest of the first 64 KiB segment.
+STAGE2_MAX_BYTES = 0x10000 - 0x8000
+
+# Encoded size in bytes of each VM op (opcode byte plus operands), and of
+# the fixed data in VM_DATA_HEADER / VM_DATA_SCRATCH.
+VM_OP_SIZES = {
+    "PRINT_STR": 3, "HALT": 1, "PRINT_VAR": 2, "SET_STR": 4, "SET_VAR": 3,
+    "INPUT": 2, "INPUT_WORDS": 7, "IF_NE_STR": 6, "IF_NUM_VI": 7, "IF_NUM_VV": 6,
+    "GOTO": 3, "CALL": 3, "RET": 1, "NL": 1, "SET_COLOR": 3, "RESET_COLOR": 1,
+    "CLEAR": 1, "NO_NL": 1, "FILL_LINE": 1, "FILL_LINES": 2, "DRAW_BOX": 4,
+    "SET_CURSOR_VV": 3, "SET_CURSOR_II": 3, "MATH_VI": 6, "MATH_VV": 5,
+}
+VM_FIXED_DATA_SIZE = 80 + 1 + 32 + 1 + 2 + 16 + 16 + 6
+VM_VAR_SLOT_SIZE = 64 + 2
+
+# Assembly for each VM op, keyed by opcode name. Each entry takes the op
+# tuple and the variable slot map and returns the op's db/dw lines.
+VM_OP_ASM = {
+    "PRINT_STR": lambda op, vm: f"    db 0x01\n    dw {op[1]}",
+    "HALT": lambda op, vm: "    db 0x00",
+    "PRINT_VAR": lambda op, vm: f"    db 0x02\n    db {vm[op[1]]}",
+    "SET_STR": lambda op, vm: f"    db 0x03\n    db {vm[op[1]]}\n    dw {op[2]}",
+    "SET_VAR": lambda op, vm: f"    db 0x04\n    db {vm[op[1]]}\n    db {vm[op[2]]}",
+    "INPUT": lambda op, vm: f"    db 0x05\n    db {vm[op[1]]}",
+    "INPUT_WORDS": lambda op, vm: (
+        f"    db 0x19\n    db {vm[op[1]]}\n    db {vm[op[2]]}\n    db {vm[op[3]]}"
+        f"\n    db {vm[op[4]]}\n    db {vm[op[5]]}\n    db {vm[op[6]]}"
+    ),
+    "IF_NE_STR": lambda op, vm: f"    db 0x06\n    db {vm[op[1]]}\n    dw {op[2]}\n    dw {op[3]}",
+    "IF_NUM_VI": lambda op, vm: f"    db 0x17\n    db {vm[op[1]]}\n    db {op[2]}\n    dw {op[3]}\n    dw {op[4]}",
+    "IF_NUM_VV": lambda op, vm: f"    db 0x18\n    db {vm[op[1]]}\n    db {op[2]}\n    db {vm[op[3]]}\n    dw {op[4]}",
+    "GOTO": lambda op, vm: f"    db 0x07\n    dw {op[1]}",
+    "CALL": lambda op, vm: f"    db 0x08\n    dw {op[1]}",
+    "RET": lambda op, vm: "    db 0x09",
+    "NL": lambda op, vm: "    db 0x0B",
+    "SET_COLOR": lambda op, vm: f"    db 0x0C\n    db {0 if op[1] == 'FG' else 1}\n    db {op[2]}",
+    "RESET_COLOR": lambda op, vm: "    db 0x15",
+    "CLEAR": lambda op, vm: "    db 0x0D",
+    "NO_NL": lambda op, vm: "    db 0x0E",
+    "FILL_LINE": lambda op, vm: "    db 0x14",
+    "FILL_LINES": lambda op, vm: f"    db 0x16\n    db {op[1]}",
+    "DRAW_BOX": lambda op, vm: f"    db 0x0F\n    db {op[1]}\n    db {op[2]}\n    db {ord(op[3])}",
+    "SET_CURSOR_VV": lambda op, vm: f"    db 0x12\n    db {vm[op[1]]}\n    db {vm[op[2]]}",
+    "SET_CURSOR_II": lambda op, vm: f"    db 0x13\n    db {op[1]}\n    db {op[2]}",
+    "MATH_VI": lambda op, vm: f"    db 0x10\n    db {vm[op[1]]}\n    db {vm[op[2]]}\n    db {ord(op[3])}\n    dw {op[4]}",
+    "MATH_VV": lambda op, vm: f"    db 0x11\n    db {vm[op[1]]}\n    db {vm[op[2]]}\n    db {ord(op[3])}\n    db {vm[op[4]]}",
+}
+
+# Bare one-word commands that compile to a single operand-less op. HALT is
+# also accepted in any case, see compile_lines.
+VM_BARE_OPS = {
+    "ResetColor": ("RESET_COLOR",),
+    "ClearScreen": ("CLEAR",),
+    "HALT": ("HALT",),
+    "FillLine": ("FILL_LINE",),
+}
+
+# Fixed parts of the generated VM program section; only the bytecode,
+# variable slots and string data vary between builds.
+VM_PROGRAM_HEADER = """; -------------- Bytecode --------------
+program:"""
+
+VM_DATA_HEADER = """
+; -------------- Data --------------
+inbuf: times 80 db 0
+call_sp db 0
+call_stack: times 16 dw 0"""
+
+VM_DATA_SCRATCH = """current_attr db 0x07
+cursor_pos dw 0
+tmpbuf: times 16 db 0
+tmpbuf_rev: times 16 db 0
+input_idx db 0
+word1_idx db 0
+word2_idx db 0
+word3_idx db 0
+wordcount_idx db 0
+wordrest_idx db 0"""
+
 
 def compiler_substitute_variables(text, compiler_vars):
     """Replace <`VAR`> with values from compiler_vars."""
-    matches = re.findall(r"<`(.*?)`>", text)
-    for var in matches:
-        value = compiler_vars.get(var, f"<UNDEFINED:{var}>")
-        text = text.replace(f"<`{var}`>", value)
-    return text
+    if "<`" not in text:
+        return text
+    return VAR_SUB_RE.sub(lambda m: compiler_vars.get(m.group(1), f"<UNDEFINED:{m.group(1)}>"), text)
 
 
 def compiler_parse_token_value(token, compiler_vars):
@@ -1208,93 +1575,18 @@ def compiler_parse_token_value(token, compiler_vars):
 
 def compiler_eval_math(expr, compiler_vars):
     """Evaluate Math(...) during compile-time using compiler variables."""
-    import ast
-
     expr = expr.strip()
     expr = compiler_substitute_variables(expr, compiler_vars)
     if expr.startswith('"') and expr.endswith('"'):
         expr = expr[1:-1]
-
-    allowed_nodes = (
-        ast.Expression,
-        ast.BinOp,
-        ast.UnaryOp,
-        ast.Constant,
-        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
-        ast.UAdd, ast.USub,
-        ast.Load,
-    )
-
-    def _eval(node):
-        if not isinstance(node, allowed_nodes):
-            raise ValueError("Invalid math expression")
-        if isinstance(node, ast.Expression):
-            return _eval(node.body)
-        if isinstance(node, ast.Constant):
-            if isinstance(node.value, (int, float)):
-                return node.value
-            raise ValueError("Only numeric constants allowed")
-        if isinstance(node, ast.UnaryOp):
-            operand = _eval(node.operand)
-            if isinstance(node.op, ast.UAdd):
-                return +operand
-            if isinstance(node.op, ast.USub):
-                return -operand
-            raise ValueError("Invalid unary operator")
-        if isinstance(node, ast.BinOp):
-            left = _eval(node.left)
-            right = _eval(node.right)
-            if isinstance(node.op, ast.Add):
-                return left + right
-            if isinstance(node.op, ast.Sub):
-                return left - right
-            if isinstance(node.op, ast.Mult):
-                return left * right
-            if isinstance(node.op, ast.Div):
-                return left / right
-            if isinstance(node.op, ast.FloorDiv):
-                return left // right
-            if isinstance(node.op, ast.Mod):
-                return left % right
-            if isinstance(node.op, ast.Pow):
-                return left ** right
-            raise ValueError("Invalid binary operator")
-        raise ValueError("Invalid math expression")
-
-    tree = ast.parse(expr, mode="eval")
-    return _eval(tree)
+    return eval(compile_math(expr), {"__builtins__": {}}, {})
 
 
 def parse_long_source(file_path):
-    with open(file_path, "r", encoding="utf-8") as f:
-        raw_lines = f.readlines()
+    return scan_source(file_path, encoding="utf-8")
 
-    in_function = False
-    current_func = ""
-    functions_map = {}
-    main_lines = []
 
-    for raw in raw_lines:
-        stripped = strip_inline_comment(raw.strip())
-        if not stripped or stripped.startswith("//"):
-            continue
-        if stripped.startswith("StartFunction["):
-            in_function = True
-            current_func = stripped.split("StartFunction[", 1)[1].split("]", 1)[0]
-            functions_map[current_func] = []
-            continue
-        if stripped == "EndFunction":
-            in_function = False
-            current_func = ""
-            continue
-        if in_function:
-            functions_map[current_func].append(stripped)
-        else:
-            main_lines.append(stripped)
-    return main_lines, functions_map
-
-
-def compile_long_to_vm(lines, functions_map):
+def compile_long_to_vm(lines, functions_map, log_prefix=""):
     ops = []
     label_positions = {}
     strings = {}
@@ -1306,8 +1598,9 @@ def compile_long_to_vm(lines, functions_map):
     loop_counter = 0
 
     def add_string(text):
-        if text in strings:
-            return strings[text]
+        label = strings.get(text)
+        if label is not None:
+            return label
         label = f"str_{len(strings)}"
         strings[text] = label
         string_order.append(text)
@@ -1325,11 +1618,8 @@ def compile_long_to_vm(lines, functions_map):
         label_positions[name] = len(ops)
 
     def parse_display_text(raw_line, raw=False):
-        if raw:
-            pattern = r"DisplayTextRaw\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$"
-        else:
-            pattern = r"DisplayText\((.*?)\)\s*=\s*([\"'])(.*)\2\s*$"
-        match = re.match(pattern, raw_line)
+        pattern = DISPLAY_TEXT_RAW_RE if raw else DISPLAY_TEXT_RE
+        match = pattern.match(raw_line)
         if not match:
             name = "DisplayTextRaw" if raw else "DisplayText"
             raise ValueError(f"Invalid {name} syntax (must be quoted): {raw_line}")
@@ -1337,30 +1627,19 @@ def compile_long_to_vm(lines, functions_map):
         content = match.group(3).strip()
         return tag, content
 
-    def split_template(text):
-        parts = []
-        idx = 0
-        while idx < len(text):
-            start = text.find("<`", idx)
-            if start == -1:
-                if idx < len(text):
-                    parts.append(("text", text[idx:]))
-                break
-            if start > idx:
-                parts.append(("text", text[idx:start]))
-            end = text.find("`>", start + 2)
-            if end == -1:
-                parts.append(("text", text[start:]))
-                break
-            var_name = text[start + 2:end]
-            parts.append(("var", var_name))
-            idx = end + 2
-        return parts
-
     def emit_display_with_subs(content, add_newline=True):
+        if "<`" not in content:
+            # Plain literal: one PRINT_STR, no template split.
+            if content:
+                emit(("PRINT_STR", add_string(content)))
+            if add_newline:
+                emit(("NL",))
+            return
+        # Same cached split the interpreter uses: literal text at even
+        # indices, variable names at odd ones.
         parts = split_template(content)
-        for kind, value in parts:
-            if kind == "text":
+        for i, value in enumerate(parts):
+            if i % 2 == 0:
                 if value:
                     label = add_string(value)
                     emit(("PRINT_STR", label))
@@ -1372,7 +1651,7 @@ def compile_long_to_vm(lines, functions_map):
 
     def parse_math_expr(expr):
         # Supported: Math(<`VAR`>+N), Math(<`VAR`>-N), Math(<`VAR`>+<`VAR`>), Math(<`VAR`>-<`VAR`>)
-        m = re.match(r"Math\(\s*<`(.*?)`>\s*([+\-])\s*(<`(.*?)`>|\d+)\s*\)\s*$", expr)
+        m = VM_MATH_RE.match(expr)
         if not m:
             return None
         left = m.group(1).strip()
@@ -1390,16 +1669,21 @@ def compile_long_to_vm(lines, functions_map):
             if not line or line.startswith("//"):
                 continue
 
-            if line.replace(" ", "") in ("[16BIT]", "startprogram", "endprogram", "startsection", "endsection"):
+            if is_structural(line):
                 continue
 
-            if line.startswith("Label[") and "]" in line:
-                label_name = line.split("Label[", 1)[1].split("]", 1)[0].strip()
-                add_label(f"LBL_{label_name}")
+            # Only HALT is four characters long, so only it is case-folded.
+            bare_op = VM_BARE_OPS.get(line.upper() if len(line) == 4 else line)
+            if bare_op is not None:
+                emit(bare_op)
                 continue
-            if line.startswith("Label:"):
-                label_name = line[6:].strip()
-                print(f"[WARN] Deprecated label syntax 'Label:NAME' used for '{label_name}'; prefer 'Label[{label_name}]'")
+
+            match = LABEL_RE.match(line)
+            if match:
+                bracketed, legacy = match.groups()
+                label_name = (bracketed if bracketed is not None else legacy).strip()
+                if bracketed is None:
+                    print(f"[WARN] {log_prefix}Deprecated label syntax 'Label:NAME' used for '{label_name}'; prefer 'Label[{label_name}]'")
                 add_label(f"LBL_{label_name}")
                 continue
 
@@ -1414,7 +1698,7 @@ def compile_long_to_vm(lines, functions_map):
                 continue
 
             if line.startswith("SetColor["):
-                match = re.match(r"SetColor\[(FG|BG)\]\s*=\s*(.*)$", line, re.IGNORECASE)
+                match = SET_COLOR_RE.match(line)
                 if not match:
                     raise ValueError(f"Invalid SetColor syntax: {line}")
                 which = match.group(1).strip().upper()
@@ -1450,24 +1734,8 @@ def compile_long_to_vm(lines, functions_map):
                     raise ValueError(f"Unknown color '{value}' in {line}")
                 emit(("SET_COLOR", which, color_map[key]))
                 continue
-            if line == "ResetColor":
-                emit(("RESET_COLOR",))
-                continue
-
-            if line == "ClearScreen":
-                emit(("CLEAR",))
-                continue
-
-            if line.strip().upper() == "HALT":
-                emit(("HALT",))
-                continue
-
-            if line == "FillLine":
-                emit(("FILL_LINE",))
-                continue
-
             if line.startswith("FillLines[") and line.endswith("]"):
-                raw_count = line.split("FillLines[", 1)[1][:-1]
+                raw_count = line[10:-1]
                 count = compiler_parse_token_value(raw_count, {})
                 if not count.isdigit():
                     raise ValueError(f"FillLines requires a numeric count: {line}")
@@ -1475,7 +1743,7 @@ def compile_long_to_vm(lines, functions_map):
                 continue
 
             if line.startswith("SetCursor["):
-                match = re.match(r"SetCursor\[(.*?)\s*,\s*(.*?)\]\s*$", line)
+                match = SET_CURSOR_RE.match(line)
                 if not match:
                     raise ValueError(f"Invalid SetCursor syntax: {line}")
                 raw_row = match.group(1).strip()
@@ -1484,7 +1752,7 @@ def compile_long_to_vm(lines, functions_map):
                 def parse_immediate(token):
                     if token.startswith('"') and token.endswith('"'):
                         token = token[1:-1]
-                    return int(token) if re.fullmatch(r"\d+", token or "") else None
+                    return int(token) if DIGITS_RE.fullmatch(token or "") else None
 
                 row_imm = parse_immediate(raw_row)
                 col_imm = parse_immediate(raw_col)
@@ -1499,7 +1767,7 @@ def compile_long_to_vm(lines, functions_map):
                 continue
 
             if line.startswith("DrawBox["):
-                match = re.match(r"DrawBox\[(\d+)\s*,\s*(\d+)\]\s*=\s*(.*)$", line)
+                match = DRAW_BOX_RE.match(line)
                 if not match:
                     raise ValueError(f"Invalid DrawBox syntax: {line}")
                 width = int(match.group(1))
@@ -1522,7 +1790,7 @@ def compile_long_to_vm(lines, functions_map):
                 continue
 
             if line.startswith("Set["):
-                match = re.match(r"Set\[(.*?)\]\s*=\s*(.*)", line)
+                match = SET_RE.match(line)
                 if not match:
                     raise ValueError(f"Invalid Set syntax: {line}")
                 var_name = match.group(1).strip()
@@ -1556,7 +1824,7 @@ def compile_long_to_vm(lines, functions_map):
                 if raw_value.startswith('"') and raw_value.endswith('"'):
                     literal = raw_value.strip('"')
                     if "<`" in literal:
-                        print("[WARN] Variable substitution in Set[...] strings is not supported in VM compile mode.")
+                        print(f"[WARN] {log_prefix}Variable substitution in Set[...] strings is not supported in VM compile mode.")
                     label = add_string(literal)
                     add_var(var_name)
                     emit(("SET_STR", var_name, label))
@@ -1581,7 +1849,7 @@ def compile_long_to_vm(lines, functions_map):
                 else:
                     right = right_raw
                     right_is_var = False
-                    if re.fullmatch(r"-?\d+", right):
+                    if SIGNED_DIGITS_RE.fullmatch(right):
                         if right.startswith("-"):
                             raise ValueError("Numeric comparisons do not support negative immediates in VM mode")
                     else:
@@ -1602,7 +1870,7 @@ def compile_long_to_vm(lines, functions_map):
                         add_var(right)
                         emit(("IF_NUM_VV", left, op_code, right, false_label))
                     else:
-                        if not re.fullmatch(r"\d+", right):
+                        if not DIGITS_RE.fullmatch(right):
                             raise ValueError("Numeric comparisons require a numeric literal or variable")
                         emit(("IF_NUM_VI", left, op_code, int(right), false_label))
                 else:
@@ -1646,12 +1914,12 @@ def compile_long_to_vm(lines, functions_map):
                 continue
 
             if line.startswith("Goto["):
-                label = line.split("Goto[", 1)[1].split("]", 1)[0]
+                label = bracket_arg(line, 5)
                 emit(("GOTO", f"LBL_{label}"))
                 continue
 
             if line.startswith("CallFunction["):
-                match = re.match(r"CallFunction\[(.*?)\]\s*(?:->\s*(\S+)\s*)?$", line)
+                match = CALL_FUNCTION_RE.match(line)
                 if not match:
                     raise ValueError(f"Invalid CallFunction syntax: {line}")
                 func = match.group(1).strip()
@@ -1669,7 +1937,7 @@ def compile_long_to_vm(lines, functions_map):
                 continue
 
             if line.startswith("Return[") and line.endswith("]"):
-                raw_value = line.split("Return[", 1)[1][:-1].strip()
+                raw_value = line[7:-1].strip()
                 add_var("__RETVAL")
                 if not raw_value:
                     label = add_string("")
@@ -1703,212 +1971,190 @@ def compile_long_to_vm(lines, functions_map):
 
 
 def build_vm_program_asm(ops, label_positions, variables_map, strings, string_order):
-    labels_by_index = {}
-    for name, idx in label_positions.items():
-        labels_by_index.setdefault(idx, []).append(name)
-
-    lines = []
-    lines.append("; -------------- Bytecode --------------")
-    lines.append("program:")
-
+    # Labels in op order (stable, so same-index labels keep their order);
+    # a cursor walks them in step with the ops.
+    sorted_labels = sorted(label_positions.items(), key=lambda item: item[1])
+    label_count = len(sorted_labels)
+    li = 0
+
+    lines = [VM_PROGRAM_HEADER]
+
+    # Locals for the per-op loop.
+    append = lines.append
+    get_op_asm = VM_OP_ASM.get
+    vm = variables_map
     for idx, op in enumerate(ops):
-        for label in labels_by_index.get(idx, []):
-            lines.append(f"{label}:")
-        lines.append(f"L{idx}:")
-        opcode = op[0]
-        if opcode == "PRINT_STR":
-            lines.append("    db 0x01")
-            lines.append(f"    dw {op[1]}")
-        elif opcode == "HALT":
-            lines.append("    db 0x00")
-        elif opcode == "PRINT_VAR":
-            lines.append("    db 0x02")
-            lines.append(f"    db {variables_map[op[1]]}")
-        elif opcode == "SET_STR":
-            lines.append("    db 0x03")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    dw {op[2]}")
-        elif opcode == "SET_VAR":
-            lines.append("    db 0x04")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {variables_map[op[2]]}")
-        elif opcode == "INPUT":
-            lines.append("    db 0x05")
-            lines.append(f"    db {variables_map[op[1]]}")
-        elif opcode == "INPUT_WORDS":
-            lines.append("    db 0x19")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {variables_map[op[2]]}")
-            lines.append(f"    db {variables_map[op[3]]}")
-            lines.append(f"    db {variables_map[op[4]]}")
-            lines.append(f"    db {variables_map[op[5]]}")
-            lines.append(f"    db {variables_map[op[6]]}")
-        elif opcode == "IF_NE_STR":
-            lines.append("    db 0x06")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    dw {op[2]}")
-            lines.append(f"    dw {op[3]}")
-        elif opcode == "IF_NUM_VI":
-            lines.append("    db 0x17")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {op[2]}")
-            lines.append(f"    dw {op[3]}")
-            lines.append(f"    dw {op[4]}")
-        elif opcode == "IF_NUM_VV":
-            lines.append("    db 0x18")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {op[2]}")
-            lines.append(f"    db {variables_map[op[3]]}")
-            lines.append(f"    dw {op[4]}")
-        elif opcode == "GOTO":
-            lines.append("    db 0x07")
-            lines.append(f"    dw {op[1]}")
-        elif opcode == "CALL":
-            lines.append("    db 0x08")
-            lines.append(f"    dw {op[1]}")
-        elif opcode == "RET":
-            lines.append("    db 0x09")
-        elif opcode == "NL":
-            lines.append("    db 0x0B")
-        elif opcode == "SET_COLOR":
-            lines.append("    db 0x0C")
-            lines.append("    db 0" if op[1] == "FG" else "    db 1")
-            lines.append(f"    db {op[2]}")
-        elif opcode == "RESET_COLOR":
-            lines.append("    db 0x15")
-        elif opcode == "CLEAR":
-            lines.append("    db 0x0D")
-        elif opcode == "NO_NL":
-            lines.append("    db 0x0E")
-        elif opcode == "FILL_LINE":
-            lines.append("    db 0x14")
-        elif opcode == "FILL_LINES":
-            lines.append("    db 0x16")
-            lines.append(f"    db {op[1]}")
-        elif opcode == "DRAW_BOX":
-            lines.append("    db 0x0F")
-            lines.append(f"    db {op[1]}")
-            lines.append(f"    db {op[2]}")
-            lines.append(f"    db {ord(op[3])}")
-        elif opcode == "SET_CURSOR_VV":
-            lines.append("    db 0x12")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {variables_map[op[2]]}")
-        elif opcode == "SET_CURSOR_II":
-            lines.append("    db 0x13")
-            lines.append(f"    db {op[1]}")
-            lines.append(f"    db {op[2]}")
-        elif opcode == "MATH_VI":
-            lines.append("    db 0x10")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {variables_map[op[2]]}")
-            lines.append(f"    db {ord(op[3])}")
-            lines.append(f"    dw {op[4]}")
-        elif opcode == "MATH_VV":
-            lines.append("    db 0x11")
-            lines.append(f"    db {variables_map[op[1]]}")
-            lines.append(f"    db {variables_map[op[2]]}")
-            lines.append(f"    db {ord(op[3])}")
-            lines.append(f"    db {variables_map[op[4]]}")
-        else:
-            raise ValueError(f"Unknown opcode: {opcode}")
-
-    if labels_by_index.get(len(ops)):
-        for label in labels_by_index[len(ops)]:
-            lines.append(f"{label}:")
+        while li < label_count and sorted_labels[li][1] == idx:
+            append(f"{sorted_labels[li][0]}:")
+            li += 1
+        op_asm = get_op_asm(op[0])
+        if op_asm is None:
+            raise ValueError(f"Unknown opcode: {op[0]}")
+        append(f"L{idx}:\n{op_asm(op, vm)}")
+
+    # Labels placed after the last op.
+    for label, _ in sorted_labels[li:]:
+        lines.append(f"{label}:")
 
     lines.append("program_end:")
     lines.append("    db 0x0A")
 
-    lines.append("")
-    lines.append("; -------------- Data --------------")
-    lines.append("inbuf: times 80 db 0")
-    lines.append("call_sp db 0")
-    lines.append("call_stack: times 16 dw 0")
+    lines.append(VM_DATA_HEADER)
 
     var_count = max(1, len(variables_map))
-    for i in range(var_count):
-        lines.append(f"var_{i}: times 64 db 0")
+    lines.extend(f"var_{i}: times 64 db 0" for i in range(var_count))
     lines.append("var_table:")
-    for i in range(var_count):
-        lines.append(f"    dw var_{i}")
-    lines.append("current_attr db 0x07")
-    lines.append("cursor_pos dw 0")
-    lines.append("tmpbuf: times 16 db 0")
-    lines.append("tmpbuf_rev: times 16 db 0")
-    lines.append("input_idx db 0")
-    lines.append("word1_idx db 0")
-    lines.append("word2_idx db 0")
-    lines.append("word3_idx db 0")
-    lines.append("wordcount_idx db 0")
-    lines.append("wordrest_idx db 0")
-
-    for text in string_order:
-        label = strings[text]
-        safe = text.replace("\\", "\\\\").replace('"', '\\"')
-        if "\n" in safe:
-            safe = safe.replace("\\n", "\" , 0x0D, 0x0A, \"")
-        lines.append(f"{label} db \"{safe}\", 0")
+    lines.extend(f"    dw var_{i}" for i in range(var_count))
+    lines.append(VM_DATA_SCRATCH)
+
+    lines.extend(f"{strings[text]} db {nasm_literal(text)}" for text in string_order)
 
     return "\n".join(lines)
 
 
-def replace_section(text, start_marker, end_marker, new_section):
+def vm_program_size(ops, variables_map, string_order):
+    """Bytes taken by the program section: (bytecode, variables, strings)."""
+    code = sum(VM_OP_SIZES.get(op[0], 0) for op in ops) + 1
+    var_data = max(1, len(variables_map)) * VM_VAR_SLOT_SIZE + VM_FIXED_DATA_SIZE
+    string_data = sum(len(text.replace("\n", "\r\n").encode("utf-8")) + 1 for text in string_order)
+    return code, var_data, string_data
+
+def nasm_literal(text):
+    """Render text as a NUL-terminated db operand list.
+
+    NASM does not process escapes inside double quotes, so printable runs
+    stay quoted and everything else is written as byte values (newlines
+    as CR LF).
+    """
+    parts = []
+    for i, chunk in enumerate(NASM_UNQUOTABLE_RE.split(text)):
+        if not chunk:
+            continue
+        if i % 2 == 0:
+            parts.append(f'"{chunk}"')
+        else:
+            parts.extend(str(b) for b in chunk.replace("\n", "\r\n").encode("utf-8"))
+    parts.append("0")
+    return ", ".join(parts)
+
+def split_section(text, start_marker, end_marker):
+    """Return the template text before and after the marked section."""
+    # The end marker is searched for only after the start marker, so the
+    # template is scanned once front to back.
     start_idx = text.find(start_marker)
-    end_idx = text.find(end_marker)
-    if start_idx == -1 or end_idx == -1 or end_idx < start_idx:
+    if start_idx != -1:
+        start_idx += len(start_marker)
+    end_idx = -1 if start_idx == -1 else text.find(end_marker, start_idx)
+    if end_idx == -1:
         raise ValueError(f"Template markers not found: {start_marker} / {end_marker}")
-    start_idx += len(start_marker)
-    return text[:start_idx] + "\n" + new_section + "\n" + text[end_idx:]
+    return text[:start_idx], text[end_idx:]
+
+
+@lru_cache(maxsize=None)
+def nasm_path():
+    """Absolute path of nasm, looked up on PATH once."""
+    return shutil.which("nasm")
 
+def assemble(asm_path, bin_path, log_prefix=""):
+    """Run nasm on asm_path, unless bin_path was already built from the same source.
 
-def compile_to_boot_sector(source_file, output_file):
+    The digest of the last successfully assembled source is kept next to it
+    in a .sha file. log_prefix is put in front of diagnostics.
+    """
+    import hashlib
+    with open(asm_path, "rb") as f:
+        digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    sha_path = asm_path + ".sha"
+    try:
+        with open(sha_path, "r", encoding="utf-8") as f:
+            if f.read().strip() == digest and os.path.isfile(bin_path):
+                return
+    except FileNotFoundError:
+        pass
+
+    # Drop the old digest before nasm touches bin_path, so a .bin left by an
+    # interrupted or failed run is never matched against a stale digest.
+    try:
+        os.remove(sha_path)
+    except FileNotFoundError:
+        pass
+
+    nasm = nasm_path()
+    if nasm is None:
+        print(f"[ERROR] {log_prefix}nasm not found. Install nasm or assemble the generated .asm manually.")
+        sys.exit(1)
+    # nasm needs no stdin and no inherited descriptors beyond stdout/stderr,
+    # so skip the close-all-fds sweep before exec.
+    res = subprocess.run(
+        [nasm, "-f", "bin", asm_path, "-o", bin_path],
+        check=False, close_fds=False, stdin=subprocess.DEVNULL,
+    )
+    if res.returncode != 0:
+        print(f"[ERROR] {log_prefix}nasm failed to assemble {os.path.basename(asm_path)}. Ensure nasm is installed and on PATH.")
+        sys.exit(1)
+
+    with open(sha_path, "w", encoding="utf-8") as f:
+        f.write(digest)
+
+def compile_to_boot_sector(source_file, output_file, build_dir=None, log_prefix=""):
+    """Compile source_file to a bootable image at output_file.
+
+    log_prefix is put in front of every message, so that concurrent batch
+    builds can be told apart.
+    """
     if not os.path.isfile(source_file):
-        print(f"Source file not found: {source_file}")
+        print(f"{log_prefix}Source file not found: {source_file}")
         sys.exit(1)
 
     repo_root = get_repo_root()
-    build_dir = os.path.join(repo_root, "build")
+    if build_dir is None:
+        build_dir = os.path.join(repo_root, "build")
     ensure_dir(build_dir)
 
     main_lines, functions_map = parse_long_source(source_file)
     try:
-        ops, label_positions, variables_map, strings, string_order = compile_long_to_vm(main_lines, functions_map)
+        ops, label_positions, variables_map, strings, string_order = compile_long_to_vm(main_lines, functions_map, log_prefix)
     except ValueError as e:
-        print(f"[ERROR] {e}")
+        print(f"[ERROR] {log_prefix}{e}")
+        sys.exit(1)
+
+    # The VM itself needs room too, so this only rejects programs that cannot
+    # fit at all, before any asm is written or nasm is run.
+    code_size, var_size, string_size = vm_program_size(ops, variables_map, string_order)
+    total_size = code_size + var_size + string_size
+    if total_size > STAGE2_MAX_BYTES:
+        print(
+            f"[ERROR] {log_prefix}Program needs {total_size} bytes but stage2 can hold at most {STAGE2_MAX_BYTES} "
+            f"(bytecode {code_size}, variables {var_size}, strings {string_size})."
+        )
         sys.exit(1)
 
     program_asm = build_vm_program_asm(ops, label_positions, variables_map, strings, string_order)
 
     stage2_template = os.path.join(repo_root, "boot", "boot_stage2.asm")
-    with open(stage2_template, "r", encoding="utf-8") as f:
+    # Templates are handled as bytes end to end; the generated program is
+    # encoded once and nothing else is decoded or re-encoded.
+    with open(stage2_template, "rb") as f:
         template_text = f.read()
 
     try:
-        template_text = replace_section(
+        head, tail = split_section(
             template_text,
-            "; === LONGC_PROGRAM_START",
-            "; === LONGC_PROGRAM_END",
-            program_asm,
+            b"; === LONGC_PROGRAM_START",
+            b"; === LONGC_PROGRAM_END",
         )
     except ValueError as e:
-        print(f"[ERROR] {e}")
+        print(f"[ERROR] {log_prefix}{e}")
         sys.exit(1)
 
+    # Write the template around the program section directly rather than
+    # building the spliced text in memory first.
     stage2_asm_path = os.path.join(build_dir, "boot_stage2.asm")
-    with open(stage2_asm_path, "w", encoding="utf-8") as f:
-        f.write(template_text)
+    with open(stage2_asm_path, "wb") as f:
+        f.writelines((head, b"\n", program_asm.encode("utf-8"), b"\n", tail))
 
-    try:
-        import subprocess
-        stage2_bin_path = os.path.join(build_dir, "boot_stage2.bin")
-        res = subprocess.run(["nasm", "-f", "bin", stage2_asm_path, "-o", stage2_bin_path], check=False)
-        if res.returncode != 0:
-            print("[ERROR] nasm failed to assemble boot_stage2.asm. Ensure nasm is installed and on PATH.")
-            sys.exit(1)
-    except FileNotFoundError:
-        print("[ERROR] nasm not found. Install nasm or assemble the generated .asm manually.")
-        sys.exit(1)
+    stage2_bin_path = os.path.join(build_dir, "boot_stage2.bin")
+    assemble(stage2_asm_path, stage2_bin_path, log_prefix)
 
     stage2_size = os.path.getsize(stage2_bin_path)
     stage2_sectors = (stage2_size + 511) // 512
@@ -1916,44 +2162,71 @@ def compile_to_boot_sector(source_file, output_file):
         stage2_sectors = 1
 
     stage1_template = os.path.join(repo_root, "boot", "boot_stage1.asm")
-    with open(stage1_template, "r", encoding="utf-8") as f:
+    with open(stage1_template, "rb") as f:
         stage1_text = f.read()
-    stage1_text = re.sub(r"STAGE2_SECTORS\s+equ\s+\d+", f"STAGE2_SECTORS equ {stage2_sectors}", stage1_text)
+    stage1_text = STAGE2_SECTORS_RE.sub(b"STAGE2_SECTORS equ %d" % stage2_sectors, stage1_text)
 
     stage1_asm_path = os.path.join(build_dir, "boot_stage1.asm")
-    with open(stage1_asm_path, "w", encoding="utf-8") as f:
+    with open(stage1_asm_path, "wb") as f:
         f.write(stage1_text)
 
-    try:
-        import subprocess
-        stage1_bin_path = os.path.join(build_dir, "boot_stage1.bin")
-        res = subprocess.run(["nasm", "-f", "bin", stage1_asm_path, "-o", stage1_bin_path], check=False)
-        if res.returncode != 0:
-            print("[ERROR] nasm failed to assemble boot_stage1.asm. Ensure nasm is installed and on PATH.")
-            sys.exit(1)
-    except FileNotFoundError:
-        print("[ERROR] nasm not found. Install nasm or assemble the generated .asm manually.")
-        sys.exit(1)
+    stage1_bin_path = os.path.join(build_dir, "boot_stage1.bin")
+    assemble(stage1_asm_path, stage1_bin_path, log_prefix)
 
     with open(stage1_bin_path, "rb") as f:
         stage1_bin = f.read()
     with open(stage2_bin_path, "rb") as f:
         stage2_bin = f.read()
 
-    padded_stage2 = stage2_bin.ljust(stage2_sectors * 512, b"\x00")
-    boot_img = stage1_bin + padded_stage2
-
     # Pad to 1.44MB floppy so MEMDISK reports sane CHS geometry (>=2 sectors/track)
     floppy_size = 1474560
-    if len(boot_img) < floppy_size:
-        boot_img = boot_img.ljust(floppy_size, b"\x00")
+    image_size = max(len(stage1_bin) + stage2_sectors * 512, floppy_size)
 
+    # Extending the file with truncate() zero-fills both the stage2 sector
+    # padding and the floppy padding without building them in memory.
     with open(output_file, "wb") as f:
-        f.write(boot_img)
+        f.write(stage1_bin)
+        f.write(stage2_bin)
+        f.truncate(image_size)
 
     size = os.path.getsize(output_file)
-    print(f"Wrote bootable image: {output_file} ({size} bytes)")
-    print("You can boot it in QEMU: qemu-system-i386 -drive format=raw,file=%s" % output_file)
+    print(f"{log_prefix}Wrote bootable image: {output_file} ({size} bytes)")
+    print(f"{log_prefix}You can boot it in QEMU: qemu-system-i386 -drive format=raw,file={output_file}")
+
+def compile_batch(source_files):
+    """Compile several programs to build/<name>.img, each in its own build/<name>/ dir.
+
+    Builds run on a thread pool; the Python side is cheap, and the nasm
+    subprocesses overlap since waiting on them releases the GIL.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    build_root = os.path.join(get_repo_root(), "build")
+    names = [os.path.splitext(os.path.basename(src))[0] for src in source_files]
+    if len(set(names)) != len(names):
+        print("[ERROR] Batch sources must have distinct file names.")
+        sys.exit(1)
+
+    def compile_one(source_file, name):
+        output_file = os.path.join(build_root, name + ".img")
+        compile_to_boot_sector(source_file, output_file, os.path.join(build_root, name), f"{source_file}: ")
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(compile_one, src, name) for src, name in zip(source_files, names)]
+
+    failed = []
+    for src, future in zip(source_files, futures):
+        try:
+            future.result()
+        except SystemExit:
+            # compile_to_boot_sector has already printed why it stopped.
+            failed.append(src)
+        except Exception as e:
+            print(f"[ERROR] {src}: {e}")
+            failed.append(src)
+    if failed:
+        print(f"[ERROR] {len(failed)} of {len(source_files)} programs failed: {', '.join(failed)}")
+        sys.exit(1)
 
 # ------------------------------
 # Entry Point
@@ -1961,9 +2234,15 @@ def compile_to_boot_sector(source_file, output_file):
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python longc.py <program.long> [output.img]")
+        print("       python longc.py --batch <program.long>...")
         sys.exit(1)
 
-    if len(sys.argv) == 3 and (sys.argv[2].endswith(".bin") or sys.argv[2].endswith(".img")):
+    if sys.argv[1] == "--batch":
+        if len(sys.argv) < 3:
+            print("Usage: python longc.py --batch <program.long>...")
+            sys.exit(1)
+        compile_batch(sys.argv[2:])
+    elif len(sys.argv) == 3 and (sys.argv[2].endswith(".bin") or sys.argv[2].endswith(".img")):
         compile_to_boot_sector(sys.argv[1], sys.argv[2])
     elif len(sys.argv) == 2 and sys.argv[1].endswith(".long"):
         default_output = os.path.join(get_repo_root(), "build", "boot.img")